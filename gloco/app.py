@@ -114,15 +114,35 @@ class AppGUI(AppBase):
         pass
 
     def show_about(self):
-        about_dialog = AboutDialog()
+        about_dialog = gloco.gui.AboutDialog()
         about_dialog.run()
 
-if gloco.gui.gui_available():
-    from gloco.gui import AboutDialog
-    
-    App = AppGUI
-else:
-    App = AppConsole
+def get_app_class():
+    """
+    Returns AppGUI if a graphical environment is available, and AppConsole
+    otherwise. The GUI toolkit is only probed when this is first called, not
+    when this module is imported.
+    """
+    if gloco.gui.gui_available():
+        return AppGUI
+    else:
+        return AppConsole
+
+class App(AppBase):
+    """
+    App that runs on a graphical environment if one is available, and on a
+    console otherwise. The choice is made by get_app_class() the first time
+    it matters, so the GUI toolkit is not probed when the application is
+    created.
+    """
+    def __init__(self, shortname, description, authors=[]):
+        AppBase.__init__(self, shortname, description, authors)
+
+    def show_help(self):
+        return get_app_class().show_help.im_func(self)
+
+    def show_about(self):
+        return get_app_class().show_about.im_func(self)
 
 # GlocoApp is a global instance of App, which is automatically consulted
 # by various modules
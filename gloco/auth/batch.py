@@ -0,0 +1,122 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2005 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+gloco/auth/batch.py
+
+   concurrent authentication of many credentials
+"""
+
+import Queue
+import threading
+
+def __normalize(credentials, host):
+    """
+    Turns (user, passwd) and (user, passwd, host) items into a dictionary of
+    host -> list of (user, passwd)
+    """
+    by_host = {}
+    for item in credentials:
+        if len(item) == 2:
+            user, passwd = item
+            item_host = host
+        else:
+            user, passwd, item_host = item
+        # A list of servers is not usable as a key
+        if isinstance(item_host, list):
+            item_host = tuple(item_host)
+        by_host.setdefault(item_host, []).append((user, passwd))
+    return by_host
+
+def __work(auth_class, host, pending, results, timeout, kwargs):
+    while True:
+        try:
+            user, passwd = pending.get_nowait()
+        except Queue.Empty:
+            break
+        auth = auth_class(user, passwd, host, **kwargs)
+        try:
+            if timeout is not None:
+                auth.set_timeout(timeout)
+            result = auth.auth()
+        except Exception:
+            result = False
+        results.put((user, host, result))
+
+def __start(auth_class, credentials, host, max_in_flight, timeout, kwargs):
+    """
+    Starts the worker threads, returning the number of credentials and the
+    queue where results will show up
+    """
+    results = Queue.Queue()
+    count = 0
+    for item_host, items in __normalize(credentials, host).items():
+        pending = Queue.Queue()
+        for item in items:
+            pending.put(item)
+        count += len(items)
+        for i in range(min(max_in_flight, len(items))):
+            worker = threading.Thread(target=__work,
+                                      args=(auth_class, item_host, pending,
+                                            results, timeout, kwargs))
+            worker.setDaemon(True)
+            worker.start()
+    return count, results
+
+def auth_batch(auth_class, credentials, host=None, max_in_flight=4,
+               timeout=None, **kwargs):
+    """
+    Authenticates many credentials concurrently, yielding (user, host,
+    result) tuples as soon as each one is verified, in no particular order.
+
+    auth_class: an AuthBase subclass, such as gldap.AuthLdap
+    credentials: (user, passwd) or (user, passwd, host) items. The host
+                 argument is used for items that do not have one
+    max_in_flight: maximum number of simultaneous requests to each host
+    timeout: if given, passed to set_timeout() before each authentication
+
+    Other keyword arguments are passed to auth_class. An authentication that
+    raises an exception counts as failed.
+    """
+    count, results = __start(auth_class, credentials, host, max_in_flight,
+                             timeout, kwargs)
+    for i in range(count):
+        yield results.get()
+
+def auth_batch_background(auth_class, credentials, callback, host=None,
+                          max_in_flight=4, timeout=None, **kwargs):
+    """
+    Like auth_batch(), but returns immediately. callback(user, host, result)
+    is called from a background thread for every credential. Returns that
+    thread, which finishes after the last callback.
+    """
+    def deliver():
+        for user, item_host, result in auth_batch(auth_class, credentials,
+                                                  host, max_in_flight,
+                                                  timeout, **kwargs):
+            callback(user, item_host, result)
+    thread = threading.Thread(target=deliver)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
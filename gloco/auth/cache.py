@@ -0,0 +1,157 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2005 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+gloco/auth/cache.py
+
+   credential verification cache
+"""
+
+import os
+import time
+import hmac
+import hashlib
+import threading
+from collections import OrderedDict
+
+from base import AuthBase
+
+class CredentialCache:
+    """
+    A bounded cache of credential verification results.
+
+    Passwords are never kept, only a salted PBKDF2 hash of them, so a dump
+    of the cache is as hard to attack as a regular password database.
+    Successful verifications are kept for ttl seconds and failed ones for
+    negative_ttl seconds. When there are more than max_size entries, the
+    least recently used ones are dropped.
+    """
+    def __init__(self, ttl=300, negative_ttl=10, max_size=1000,
+                 iterations=10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.iterations = iterations
+
+        self.lock = threading.Lock()
+        # (host, user) -> (salt, hash, result, expiration time)
+        self.entries = OrderedDict()
+
+    def __hash(self, passwd, salt):
+        return hashlib.pbkdf2_hmac('sha256', passwd, salt, self.iterations)
+
+    def lookup(self, host, user, passwd):
+        """
+        Returns the cached result of verifying the given credentials, or None
+        if they have to be verified by the backend
+        """
+        key = (host, user)
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            salt, digest, result, expiration = entry
+            if expiration < time.time():
+                return None
+            self.entries[key] = entry
+        finally:
+            self.lock.release()
+
+        # Hashing is slow on purpose, so do it with the lock released
+        if hmac.compare_digest(self.__hash(passwd, salt), digest):
+            return result
+        return None
+
+    def store(self, host, user, passwd, result):
+        """
+        Stores the result of verifying the given credentials
+        """
+        salt = os.urandom(16)
+        digest = self.__hash(passwd, salt)
+        if result:
+            expiration = time.time() + self.ttl
+        else:
+            expiration = time.time() + self.negative_ttl
+
+        key = (host, user)
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (salt, digest, result, expiration)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, user, host=None):
+        """
+        Forgets about a user, on the given host or on all hosts. This must
+        be called when the user's password is changed.
+        """
+        if isinstance(host, list):
+            host = tuple(host)
+        self.lock.acquire()
+        try:
+            for key in self.entries.keys():
+                if key[1] == user and (host is None or key[0] == host):
+                    del self.entries[key]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+# Cache used by CachedAuth when none is given
+default_cache = CredentialCache()
+
+class CachedAuth(AuthBase):
+    """
+    Puts a CredentialCache in front of another AuthBase instance, so that
+    repeated authentications with the same credentials do not reach the
+    backend.
+
+    Usage: CachedAuth(AuthLdap(user, passwd, host)).auth()
+    """
+    def __init__(self, backend, cache=None):
+        AuthBase.__init__(self, backend.user, backend.passwd, backend.host,
+                          **backend.kwargs)
+        self.backend = backend
+        if cache is None:
+            cache = default_cache
+        self.cache = cache
+
+    def auth(self):
+        result = self.cache.lookup(self.host, self.user, self.passwd)
+        if result is None:
+            result = self.backend.auth()
+            self.cache.store(self.host, self.user, self.passwd, result)
+        return result
+
+    def set_timeout(self, seconds):
+        self.backend.set_timeout(seconds)
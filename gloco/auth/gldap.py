@@ -28,27 +28,634 @@ gloco/auth/gldap.py
    ldap authentication class
 """
 
+import time
+import Queue
+import threading
+
 import ldap
+import ldap.filter
+from ldap.controls import SimplePagedResultsControl
 
 from base import AuthBase
 
+class LdapConnectionPool:
+    """
+    A bounded pool of LDAP connections to a single host.
+
+    Connections are re-bound as each user being authenticated, so a single
+    connection can serve any number of authentications. Connections that sat
+    idle for longer than max_idle seconds are closed instead of reused.
+    """
+    def __init__(self, host, max_size=10, max_idle=300, connect=None):
+        self.host = host
+        self.max_size = max_size
+        self.max_idle = max_idle
+        if connect is None:
+            connect = lambda: ldap.open(self.host)
+        self.connect = connect
+
+        self.condition = threading.Condition()
+        # List of (connection, time it was released), most recent last
+        self.idle = []
+        self.size = 0
+
+    def __close(self, conn):
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def __evict_idle(self):
+        """
+        Closes the connections that were idle for too long. Must be called
+        with the condition acquired.
+        """
+        limit = time.time() - self.max_idle
+        while self.idle and self.idle[0][1] < limit:
+            conn, released = self.idle.pop(0)
+            self.size -= 1
+            self.__close(conn)
+
+    def acquire(self, timeout=None):
+        """
+        Returns a connection from the pool, opening a new one if there's room
+        for it, or waiting for one to be released otherwise. Raises
+        ldap.SERVER_DOWN if no connection is available after timeout seconds.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while True:
+                self.__evict_idle()
+                if self.idle:
+                    return self.idle.pop()[0]
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ldap.SERVER_DOWN({'desc' : 'connection pool exhausted'})
+                    self.condition.wait(remaining)
+        finally:
+            self.condition.release()
+
+        try:
+            return self.connect()
+        except:
+            self.discard(None)
+            raise
+
+    def release(self, conn):
+        """
+        Gives a healthy connection back to the pool
+        """
+        self.condition.acquire()
+        try:
+            self.idle.append((conn, time.time()))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def discard(self, conn):
+        """
+        Closes a broken connection, making room for a new one in the pool
+        """
+        if conn is not None:
+            self.__close(conn)
+        self.condition.acquire()
+        try:
+            self.size -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        self.condition.acquire()
+        try:
+            while self.idle:
+                conn, released = self.idle.pop()
+                self.size -= 1
+                self.__close(conn)
+        finally:
+            self.condition.release()
+
+# Connection pools shared by all AuthLdap instances, keyed by host
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(host, **kwargs):
+    """
+    Returns the connection pool for host, creating it on first use. kwargs
+    are passed to LdapConnectionPool when the pool is created.
+    """
+    pools_lock.acquire()
+    try:
+        if not pools.has_key(host):
+            pools[host] = LdapConnectionPool(host, **kwargs)
+        return pools[host]
+    finally:
+        pools_lock.release()
+
+class LdapServerSelector:
+    """
+    Keeps track of the latency and error rate of a set of LDAP servers, and
+    decides which one should be tried first.
+
+    Latency and error rate are exponentially weighted moving averages. A
+    server that fails failure_threshold times in a row is considered broken
+    for cooldown seconds, and is only tried after all the others. Once the
+    cooldown expires it gets tried again as usual.
+    """
+    def __init__(self, hosts, failure_threshold=3, cooldown=30, weight=0.3):
+        self.hosts = list(hosts)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.weight = weight
+
+        self.lock = threading.Lock()
+        self.latency = dict([(host, 0.0) for host in self.hosts])
+        self.error_rate = dict([(host, 0.0) for host in self.hosts])
+        self.failures = dict([(host, 0) for host in self.hosts])
+        self.broken_until = dict([(host, 0) for host in self.hosts])
+
+    def ordered(self):
+        """
+        Returns the hosts, healthy ones first, then broken ones, sorted by
+        how soon they will be tried again. Healthy hosts are sorted by their
+        latency divided by their success rate, roughly how long it takes to
+        get an answer from them, then by error rate.
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            healthy = [(self.latency[host] / max(1 - self.error_rate[host], 0.01),
+                        self.error_rate[host], host) for host in self.hosts
+                       if self.broken_until[host] <= now]
+            broken = [(self.broken_until[host], host) for host in self.hosts
+                      if self.broken_until[host] > now]
+        finally:
+            self.lock.release()
+        healthy.sort()
+        broken.sort()
+        return [item[-1] for item in healthy + broken]
+
+    def record_success(self, host, latency):
+        self.lock.acquire()
+        try:
+            if self.latency[host]:
+                self.latency[host] += self.weight * (latency - self.latency[host])
+            else:
+                self.latency[host] = latency
+            self.error_rate[host] *= (1 - self.weight)
+            self.failures[host] = 0
+            self.broken_until[host] = 0
+        finally:
+            self.lock.release()
+
+    def record_failure(self, host):
+        self.lock.acquire()
+        try:
+            self.error_rate[host] += self.weight * (1 - self.error_rate[host])
+            self.failures[host] += 1
+            if self.failures[host] >= self.failure_threshold:
+                self.broken_until[host] = time.time() + self.cooldown
+        finally:
+            self.lock.release()
+
+# Server selectors shared by all AuthLdap instances, keyed by list of hosts
+selectors = {}
+
+def get_selector(hosts, **kwargs):
+    """
+    Returns the server selector for hosts, creating it on first use. kwargs
+    are passed to LdapServerSelector when the selector is created.
+    """
+    hosts = tuple(hosts)
+    pools_lock.acquire()
+    try:
+        if not selectors.has_key(hosts):
+            selectors[hosts] = LdapServerSelector(hosts, **kwargs)
+        return selectors[hosts]
+    finally:
+        pools_lock.release()
+
 class AuthLdap(AuthBase):
+    """
+    Authenticates against a LDAP server, by binding as the user.
+
+    Connections are taken from a pool shared by all instances for the same
+    host. The pool_size, pool_max_idle and pool_timeout keyword arguments
+    tune the pool when it is first created.
+
+    host can also be a list of servers. Each bind then goes to the server
+    with the lowest latency and error rate, failing over to the next one
+    when a server is down. Servers that keep failing are skipped for a while (see
+    LdapServerSelector, tuned with the failure_threshold and cooldown
+    keyword arguments). If hedge_delay is given, a bind that takes longer
+    than that many seconds is also sent to the next server, and whichever
+    answers first is used.
+    """
     def __init__(self, user, passwd, host, **kwargs):
+        # A tuple, unlike a list, can be used as a dictionary key by
+        # CachedAuth and auth_batch()
+        if isinstance(host, list):
+            host = tuple(host)
         AuthBase.__init__(self, user, passwd, host, **kwargs)
+        self.timeout = None
+
+    def get_hosts(self):
+        if isinstance(self.host, (list, tuple)):
+            return list(self.host)
+        return [self.host]
+
+    def get_pool(self, host=None):
+        if host is None:
+            host = self.get_hosts()[0]
+        return get_pool(host,
+                        max_size=self.kwargs.get('pool_size', 10),
+                        max_idle=self.kwargs.get('pool_max_idle', 300))
+
+    def get_selector(self):
+        return get_selector(self.get_hosts(),
+                            failure_threshold=self.kwargs.get('failure_threshold', 3),
+                            cooldown=self.kwargs.get('cooldown', 30))
+
+    def __bind(self, host):
+        """
+        Binds as the user on host. Returns True or False, or None if the
+        server could not give an answer.
+        """
+        pool = self.get_pool(host)
+        # A pooled connection may have been closed by the server while idle,
+        # and if one was, the other idle ones likely were too. So if it
+        # turns out to be dead, drop them all and try once more with a
+        # freshly opened connection.
+        for attempt in range(2):
+            try:
+                conn = pool.acquire(self.kwargs.get('pool_timeout'))
+            except ldap.LDAPError:
+                return None
+            try:
+                # Pooled connections keep the options they were opened with
+                if self.timeout is not None:
+                    conn.set_option(ldap.OPT_TIMEOUT, self.timeout)
+                    conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+                conn.simple_bind_s(self.user, self.passwd)
+                pool.release(conn)
+                return True
+            except ldap.INVALID_CREDENTIALS:
+                pool.release(conn)
+                return False
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT):
+                pool.discard(conn)
+                pool.close()
+            except ldap.LDAPError:
+                pool.discard(conn)
+                return False
+        return None
+
+    def __attempt(self, selector, host):
+        """
+        Binds on host, recording how it went on the selector
+        """
+        start = time.time()
+        result = self.__bind(host)
+        if result is None:
+            selector.record_failure(host)
+        else:
+            selector.record_success(host, time.time() - start)
+        return result
+
+    def __attempt_in_background(self, selector, host, results):
+        def attempt():
+            results.put(self.__attempt(selector, host))
+        thread = threading.Thread(target=attempt)
+        thread.setDaemon(True)
+        thread.start()
 
     def auth(self):
-        try:
-            conn = ldap.open(self.host)
-            conn.simple_bind_s(self.user, self.passwd)
-            return True
-        except ldap.LDAPError:
+        selector = self.get_selector()
+        hosts = selector.ordered()
+        hedge_delay = self.kwargs.get('hedge_delay')
+
+        if hedge_delay is None or len(hosts) == 1:
+            for host in hosts:
+                result = self.__attempt(selector, host)
+                if result is not None:
+                    return result
             return False
 
+        results = Queue.Queue()
+        running = 0
+        while hosts or running:
+            if not running:
+                self.__attempt_in_background(selector, hosts.pop(0), results)
+                running += 1
+            try:
+                # Hedge at most one request at a time
+                if hosts and running == 1:
+                    result = results.get(True, hedge_delay)
+                else:
+                    result = results.get()
+            except Queue.Empty:
+                # Too slow, hedge on the next server
+                self.__attempt_in_background(selector, hosts.pop(0), results)
+                running += 1
+                continue
+            running -= 1
+            if result is not None:
+                return result
+        return False
+
     def set_timeout(self, seconds):
         # ldap has two TIMEOUTs available:
         # ldap.OPT_TIMEOUT and ldap.OPT_NETWORK_TIMEOUT
         # The first one seem to be more general, maybe this is a FIXME
         ldap.set_option(ldap.OPT_TIMEOUT, seconds)
+        # The global option only reaches new connections; both are also
+        # set on each pooled connection before it is used by __bind
+        self.timeout = seconds
+
+class LookupCache:
+    """
+    A dictionary like cache whose entries expire after ttl seconds
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expiration = entry
+            if expiration < time.time():
+                del self.entries[key]
+                return default
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            self.entries[key] = (value, time.time() + self.ttl)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key=None):
+        """
+        Forgets about key, or about everything if key is None
+        """
+        self.lock.acquire()
+        try:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+# Stands for a lookup that is not cached, as None stands for a user that
+# does not exist
+_unknown = object()
+
+class LdapDirectory:
+    """
+    Looks up user attributes and group membership on a LDAP directory.
+
+    Searches run on a pool of connections bound as bind_dn, and go through
+    the server in pages of page_size entries, so large groups can be read
+    from servers with a size limit. Results, including users not being found,
+    are cached for ttl seconds.
+    prefetch() loads many users with a single search, so that later lookups
+    for them are served from the cache.
+
+    user_attribute is the attribute that holds user names, member_attribute
+    is the attribute of groups that holds the DNs of their members, and
+    member_filter finds the users that are members of a group (given by DN).
+    """
+    # Number of users looked up by a single search in prefetch()
+    prefetch_chunk = 100
+
+    def __init__(self, host, base_dn, bind_dn='', bind_passwd='',
+                 user_attribute='uid', attributes=None,
+                 member_attribute='member', member_filter='(memberOf=%s)',
+                 ttl=300, page_size=500, pool_size=4):
+        self.host = host
+        self.base_dn = base_dn
+        self.bind_dn = bind_dn
+        self.bind_passwd = bind_passwd
+        self.user_attribute = user_attribute
+        self.attributes = attributes
+        self.member_attribute = member_attribute
+        self.member_filter = member_filter
+        self.page_size = page_size
+
+        self.pool = LdapConnectionPool(host, max_size=pool_size,
+                                       connect=self.__connect)
+        self.users = LookupCache(ttl)
+        self.groups = LookupCache(ttl)
+        self.members = LookupCache(ttl)
+
+    def __connect(self):
+        conn = ldap.open(self.host)
+        conn.simple_bind_s(self.bind_dn, self.bind_passwd)
+        return conn
+
+    def __escape(self, value):
+        return ldap.filter.escape_filter_chars(value)
+
+    def __get_attributes(self):
+        if self.attributes is None:
+            return None
+        attributes = list(self.attributes)
+        if self.user_attribute not in attributes:
+            attributes.append(self.user_attribute)
+        return attributes
+
+    def __search(self, conn, filterstr, attributes, base_dn):
+        entries = []
+        control = SimplePagedResultsControl(True, size=self.page_size,
+                                            cookie='')
+        while True:
+            msgid = conn.search_ext(base_dn, ldap.SCOPE_SUBTREE,
+                                    filterstr, attributes,
+                                    serverctrls=[control])
+            rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+            entries.extend([(dn, attrs) for dn, attrs in rdata
+                            if dn is not None])
+
+            cookie = None
+            for serverctrl in serverctrls:
+                if serverctrl.controlType == SimplePagedResultsControl.controlType:
+                    cookie = serverctrl.cookie
+            if not cookie:
+                break
+            control.cookie = cookie
+        return entries
+
+    def search(self, filterstr, attributes=None, base_dn=None):
+        """
+        Returns a list of (dn, attributes) for the entries matching
+        filterstr, fetched page by page
+        """
+        if base_dn is None:
+            base_dn = self.base_dn
+
+        # As in AuthLdap, a dead pooled connection means the other idle
+        # ones are likely dead too, so retry once on a fresh connection
+        for attempt in range(2):
+            conn = self.pool.acquire()
+            try:
+                entries = self.__search(conn, filterstr, attributes, base_dn)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT):
+                self.pool.discard(conn)
+                self.pool.close()
+                if attempt:
+                    raise
+                continue
+            except:
+                self.pool.release(conn)
+                raise
+            self.pool.release(conn)
+            return entries
+
+    def __cache_users(self, entries):
+        """
+        Caches (dn, attributes) entries of users, returning a dictionary of
+        user name to entry. User names are matched regardless of case, as
+        the server does, so they are kept in lower case.
+        """
+        found = {}
+        for dn, attrs in entries:
+            for name in attrs.get(self.user_attribute, []):
+                self.users.set(name.lower(), (dn, attrs))
+                found[name.lower()] = (dn, attrs)
+        return found
+
+    def get_user(self, user):
+        """
+        Returns (dn, attributes) of user, or None if there's no such user
+        """
+        key = user.lower()
+        entry = self.users.get(key, _unknown)
+        if entry is _unknown:
+            filterstr = '(%s=%s)' % (self.user_attribute, self.__escape(user))
+            entry = self.__cache_users(self.search(filterstr,
+                                                   self.__get_attributes())).get(key)
+            if entry is None:
+                # Remember that there's no such user, too
+                self.users.set(key, None)
+        return entry
+
+    def get_user_attributes(self, user):
+        """
+        Returns the attributes of user as a dictionary of lists, or None if
+        there's no such user
+        """
+        entry = self.get_user(user)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def get_groups(self, user):
+        """
+        Returns the DNs of the groups user belongs to
+        """
+        groups = self.groups.get(user.lower())
+        if groups is None:
+            entry = self.get_user(user)
+            if entry is None:
+                return []
+            filterstr = '(%s=%s)' % (self.member_attribute,
+                                     self.__escape(entry[0]))
+            groups = [dn for dn, attrs in self.search(filterstr, ['1.1'])]
+            self.groups.set(user.lower(), groups)
+        return groups
+
+    def is_member(self, user, group_dn):
+        """
+        Whether user belongs to the group given by its DN
+        """
+        group_dn = group_dn.lower()
+        for dn in self.get_groups(user):
+            if dn.lower() == group_dn:
+                return True
+        return False
+
+    def get_group_members(self, group_dn):
+        """
+        Returns the names of the members of the group given by its DN
+        """
+        members = self.members.get(group_dn)
+        if members is None:
+            filterstr = self.member_filter % self.__escape(group_dn)
+            entries = self.search(filterstr, self.__get_attributes())
+            self.__cache_users(entries)
+            members = []
+            for dn, attrs in entries:
+                members.extend(attrs.get(self.user_attribute, []))
+            members.sort()
+            self.members.set(group_dn, members)
+        return members
+
+    def prefetch(self, users, groups=True):
+        """
+        Loads many users, and optionally their groups, into the cache using
+        one search per prefetch_chunk users instead of one per user
+        """
+        users = list(users)
+        for start in range(0, len(users), self.prefetch_chunk):
+            chunk = users[start:start + self.prefetch_chunk]
+            filterstr = '(|%s)' % ''.join(['(%s=%s)' % (self.user_attribute,
+                                                        self.__escape(user))
+                                           for user in chunk])
+            found = self.__cache_users(self.search(filterstr,
+                                                   self.__get_attributes()))
+            for user in chunk:
+                if not found.has_key(user.lower()):
+                    self.users.set(user.lower(), None)
+            if not groups or not found:
+                continue
+
+            names = {}
+            groups_of = {}
+            for name, (dn, attrs) in found.items():
+                names[dn.lower()] = name
+                groups_of[name] = []
+            filterstr = '(|%s)' % ''.join(['(%s=%s)' % (self.member_attribute,
+                                                        self.__escape(dn))
+                                           for dn, attrs in found.values()])
+            for group_dn, attrs in self.search(filterstr,
+                                               [self.member_attribute]):
+                for member_dn in attrs.get(self.member_attribute, []):
+                    name = names.get(member_dn.lower())
+                    if name is not None:
+                        groups_of[name].append(group_dn)
+            for name, user_groups in groups_of.items():
+                self.groups.set(name, user_groups)
+
+    def invalidate(self, user=None):
+        """
+        Forgets the cached data about a user, or about everything
+        """
+        if user is not None:
+            user = user.lower()
+        self.users.invalidate(user)
+        self.groups.invalidate(user)
+        if user is None:
+            self.members.invalidate()
 
 if __name__ == '__main__':
     a = AuthLdap(raw_input('User: '),
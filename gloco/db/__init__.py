@@ -28,11 +28,18 @@ gloco/db/__init__.py
    module init file
 """
 
+# replicas is a list of servers that reads may be sent to, each a host name
+# or a dictionary overriding some of the settings above. read_policy is
+# 'round-robin' or 'least-latency', and after a write, reads keep going to
+# the primary server for sticky seconds (see DbConn)
 default_db_config = {'host' : '127.0.0.1',
                      'user' : '',
                      'passwd' : '',
                      'db' : '',
-                     'driver' : 'MySQL'}
+                     'driver' : 'MySQL',
+                     'replicas' : [],
+                     'read_policy' : 'round-robin',
+                     'sticky' : 0}
 
 driver_name_to_module = {'MySQL' : 'MySQLdb',
                          'Postgres' : 'psycopg',
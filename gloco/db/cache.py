@@ -0,0 +1,552 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2005 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+gloco/db/cache.py
+
+   query result cache
+
+   Results of SELECT queries are cached by their SQL, with whitespace
+   normalized, and parameters. Every write that goes through DbQuery or
+   SQLDict drops the cached results of the tables it writes to, in all
+   the caches of the process and, through the on-disk store, in other
+   processes sharing it. They are dropped again when the write is
+   committed through DbConn.commit() or SQLDict.commit(), as other
+   connections may have cached what they read in between. Writes made
+   some other way are only noticed when the entries expire.
+"""
+
+__all__ = ['QueryCache', 'CachedCursor', 'default_cache', 'normalize',
+           'is_cacheable', 'read_tables', 'written_tables', 'written',
+           'has_uncommitted']
+
+import os
+import re
+import time
+import stat
+import errno
+import marshal
+import weakref
+import decimal
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+
+from gloco.ext.db import SQLDict
+import conn
+
+_literal_or_space = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\")"
+                               r"|\s+")
+
+def normalize(sql):
+    """
+    Returns sql with runs of whitespace outside of literals turned into a
+    single space, and without a trailing semicolon
+    """
+    def replace(match):
+        return match.group(1) or ' '
+    return _literal_or_space.sub(replace, sql).strip().rstrip(';').strip()
+
+_select = re.compile(r'^\(?\s*SELECT\b', re.I)
+_uncacheable = re.compile(r'\b(FOR\s+UPDATE|LOCK\s+IN\s+SHARE\s+MODE|'
+                          r'SQL_NO_CACHE|INTO\s+OUTFILE|NOW|RAND|RANDOM|'
+                          r'UUID|SYSDATE|CURRENT_DATE|CURRENT_TIME|'
+                          r'CURRENT_TIMESTAMP|LAST_INSERT_ID|CURDATE|'
+                          r'CURTIME|CONNECTION_ID|GET_LOCK)\b', re.I)
+
+def is_cacheable(sql):
+    """
+    Whether sql is a read whose result only depends on the tables it reads
+    """
+    return bool(_select.match(sql)) and not _uncacheable.search(sql)
+
+_from = re.compile(r'\bFROM\s+(.*?)(?=\b(?:WHERE|GROUP|ORDER|LIMIT|HAVING|'
+                   r'UNION|SELECT|INNER|LEFT|RIGHT|FULL|CROSS|NATURAL|'
+                   r'JOIN|ON|USING)\b|[();]|$)', re.I)
+_join = re.compile(r'\bJOIN\s+([\w`".]+)', re.I)
+
+def _table_name(name):
+    return name.replace('`', '').replace('"', '').split('.')[-1].lower()
+
+def read_tables(sql):
+    """
+    Returns the names of the tables read by sql, in lower case
+    """
+    tables = set()
+    for match in _from.finditer(sql):
+        for item in match.group(1).split(','):
+            words = item.split()
+            if words and words[0][0] not in '(':
+                tables.add(_table_name(words[0]))
+    for match in _join.finditer(sql):
+        tables.add(_table_name(match.group(1)))
+    return tables
+
+_write = re.compile(r'^\s*(?:INSERT\s+(?:(?:LOW_PRIORITY|DELAYED|IGNORE)\s+)*'
+                    r'(?:INTO\s+)?|REPLACE\s+(?:INTO\s+)?|'
+                    r'UPDATE\s+(?:(?:LOW_PRIORITY|IGNORE)\s+)*|'
+                    r'DELETE\s+(?:(?:LOW_PRIORITY|QUICK|IGNORE)\s+)*FROM\s+|'
+                    r'TRUNCATE\s+(?:TABLE\s+)?|ALTER\s+TABLE\s+|'
+                    r'DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?|'
+                    r'LOAD\s+DATA\s+.*?\bINTO\s+TABLE\s+|COPY\s+)'
+                    r'([\w`".]+)', re.I | re.S)
+_harmless = re.compile(r'^\s*(SELECT|SHOW|SET|BEGIN|START|COMMIT|ROLLBACK|'
+                       r'SAVEPOINT|RELEASE|DESCRIBE|DESC|EXPLAIN|USE)\b',
+                       re.I)
+
+def written_tables(sql):
+    """
+    Returns the names of the tables written by sql, in lower case. An empty
+    set means sql does not write; None means it may write anywhere.
+    """
+    match = _write.match(sql)
+    if match:
+        return set([_table_name(match.group(1))])
+    if _harmless.match(sql):
+        return set()
+    return None
+
+# Every QueryCache of the process, so that writes reach all of them
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+def _register(cache):
+    _caches_lock.acquire()
+    try:
+        _caches[cache] = True
+    finally:
+        _caches_lock.release()
+
+# DbConn -> tables it wrote since its last commit, None for all of them
+_uncommitted = weakref.WeakKeyDictionary()
+
+def written(tables, db_conn=None):
+    """
+    Drops the cached results of the given tables from every cache. None
+    drops everything. If the write was made through db_conn, a DbConn,
+    they are dropped again when it commits.
+    """
+    _caches_lock.acquire()
+    try:
+        caches = _caches.keys()
+        if db_conn is not None:
+            pending = _uncommitted.get(db_conn, set())
+            if tables is None or pending is None:
+                _uncommitted[db_conn] = None
+            else:
+                _uncommitted[db_conn] = pending | set(tables)
+    finally:
+        _caches_lock.release()
+    for cache in caches:
+        if tables is None:
+            cache.clear()
+        else:
+            cache.invalidate(tables)
+
+def has_uncommitted(db_conn):
+    """
+    Whether db_conn, a DbConn, wrote since its last commit or rollback
+    """
+    _caches_lock.acquire()
+    try:
+        return _uncommitted.has_key(db_conn)
+    finally:
+        _caches_lock.release()
+
+def _committed(db_conn):
+    _caches_lock.acquire()
+    try:
+        if not _uncommitted.has_key(db_conn):
+            return
+        tables = _uncommitted.pop(db_conn)
+    finally:
+        _caches_lock.release()
+    written(tables)
+
+conn.commit_listeners.append(_committed)
+
+def _sqldict_written(table):
+    written([table])
+
+SQLDict.write_listeners.append(_sqldict_written)
+
+class CachedCursor:
+    """
+    Stands in for a cursor, returning the rows of a cached result. If a
+    cursor is given, its rows are returned after the given ones.
+    """
+    def __init__(self, description, rows, cursor=None):
+        self.description = description
+        self.rows = rows
+        self.cursor = cursor
+        self.pos = 0
+        self.arraysize = 1
+        if cursor is None:
+            self.rowcount = len(rows)
+        else:
+            self.rowcount = cursor.rowcount
+
+    def fetchone(self):
+        if self.pos < len(self.rows):
+            self.pos += 1
+            return self.rows[self.pos - 1]
+        if self.cursor is not None:
+            return self.cursor.fetchone()
+        return None
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = list(self.rows[self.pos:self.pos + size])
+        self.pos += len(rows)
+        if len(rows) < size and self.cursor is not None:
+            rows.extend(self.cursor.fetchmany(size - len(rows)))
+        return rows
+
+    def fetchall(self):
+        rows = list(self.rows[self.pos:])
+        self.pos = len(self.rows)
+        if self.cursor is not None:
+            rows.extend(self.cursor.fetchall())
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                break
+            yield row
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+
+# On disk, values marshal can't hold are stored as (_tag, type, fields)
+_tag = '\0gloco.db.cache'
+
+def _encode_value(value):
+    kind = type(value)
+    if kind is datetime.datetime and value.tzinfo is None:
+        return (_tag, 'datetime', (value.year, value.month, value.day,
+                                   value.hour, value.minute, value.second,
+                                   value.microsecond))
+    if kind is datetime.date:
+        return (_tag, 'date', (value.year, value.month, value.day))
+    if kind is datetime.time and value.tzinfo is None:
+        return (_tag, 'time', (value.hour, value.minute, value.second,
+                               value.microsecond))
+    if kind is datetime.timedelta:
+        return (_tag, 'timedelta', (value.days, value.seconds,
+                                    value.microseconds))
+    if kind is decimal.Decimal:
+        return (_tag, 'decimal', str(value))
+    return value
+
+_decoders = {'datetime' : lambda fields: datetime.datetime(*fields),
+             'date' : lambda fields: datetime.date(*fields),
+             'time' : lambda fields: datetime.time(*fields),
+             'timedelta' : lambda fields: datetime.timedelta(*fields),
+             'decimal' : decimal.Decimal}
+
+def _decode_value(value):
+    if type(value) is tuple and len(value) == 3 and value[0] == _tag:
+        return _decoders[value[1]](value[2])
+    return value
+
+def _dump_entry(entry):
+    """
+    Returns entry as a string for the on-disk store. marshal is used
+    rather than pickle, as loading it can't run code. Raises ValueError
+    if some value can't be stored.
+    """
+    created, expiration, tables, description, rows = entry
+    description = tuple([tuple(column) for column in description or ()])
+    rows = tuple([tuple([_encode_value(value) for value in row])
+                  for row in rows])
+    return marshal.dumps((created, expiration, tables, description, rows))
+
+def _load_entry(data):
+    created, expiration, tables, description, rows = marshal.loads(data)
+    rows = tuple([tuple([_decode_value(value) for value in row])
+                  for row in rows])
+    return created, expiration, tables, description, rows
+
+class QueryCache:
+    """
+    A bounded cache of query results.
+
+    Results are kept for ttl seconds, and when there are more than max_size
+    of them, the least recently used ones are dropped. Results with more
+    than max_rows rows are not cached. If path is given, results are also
+    stored there, one file per query, and shared with the other processes
+    using the same path; invalidations go there too. The files of expired
+    results, and the oldest ones beyond max_size, are deleted every
+    max_size / 10 stores (see prune). Results with values that can't be
+    stored on disk are only kept in memory.
+
+    Whoever can write to path can make the cache return any rows, so it
+    must be a directory only trusted processes can write to. It is
+    created with mode 0700, and if it already exists, it must be owned
+    by the current user and not be accessible by anyone else.
+    """
+    def __init__(self, ttl=60, max_size=1000, max_rows=10000, path=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.path = path
+        if path is not None:
+            for directory in (path, os.path.join(path, 'tables')):
+                try:
+                    os.makedirs(directory, 0700)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                info = os.stat(directory)
+                if info.st_uid != os.getuid() or \
+                        stat.S_IMODE(info.st_mode) & 077:
+                    raise ValueError, ('cache directory %s must be owned '
+                                       'by the current user and have mode '
+                                       '0700' % directory)
+
+        self.lock = threading.Lock()
+        # key -> (creation time, expiration time, tables, description, rows)
+        self.entries = OrderedDict()
+        # table -> set of keys
+        self.tables = {}
+        # table -> time it was last invalidated, '*' for clear()
+        self.invalidated = {}
+        self.unpruned = 0
+        self.stats = {'hits' : 0, 'misses' : 0, 'stores' : 0,
+                      'invalidations' : 0}
+        _register(self)
+
+    def key(self, sql, params=None):
+        return (normalize(sql), repr(params))
+
+    def __file(self, key):
+        return os.path.join(self.path,
+                            hashlib.md5(repr(key)).hexdigest() + '.entry')
+
+    def __stamp_file(self, table):
+        return os.path.join(self.path, 'tables', table)
+
+    def __stamp(self, table):
+        try:
+            return float(open(self.__stamp_file(table)).read())
+        except (IOError, ValueError):
+            return 0.0
+
+    def __valid(self, entry):
+        created, expiration, tables = entry[:3]
+        if expiration < time.time():
+            return False
+        if self.path is not None:
+            for table in list(tables) + ['*']:
+                if self.__stamp(table) >= created:
+                    return False
+        return True
+
+    def lookup(self, sql, params=None):
+        """
+        Returns the cached (description, rows) of a query, or None
+        """
+        key = self.key(sql, params)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+        finally:
+            self.lock.release()
+        in_memory = entry is not None
+
+        if entry is None and self.path is not None:
+            try:
+                entry = _load_entry(open(self.__file(key), 'rb').read())
+            except (IOError, EOFError, ValueError, TypeError, KeyError):
+                entry = None
+        valid = entry is not None and self.__valid(entry)
+
+        # Only touch the entry if no other thread replaced or invalidated
+        # it meanwhile
+        self.lock.acquire()
+        try:
+            current = self.entries.get(key)
+            if in_memory and current is entry:
+                del self.entries[key]
+                if valid:
+                    # Most recently used go last
+                    self.entries[key] = entry
+                else:
+                    self.__unindex(key, entry)
+            elif valid and current is None:
+                self.__add(key, entry)
+        finally:
+            self.lock.release()
+
+        if not valid:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return entry[3], entry[4]
+
+    def store(self, sql, params, description, rows, tables=None,
+              started=None):
+        """
+        Stores the result of a query. tables are the tables it reads; they
+        are found in sql if not given. started is the time the query was
+        sent; the result is not stored if one of its tables was
+        invalidated since then.
+        """
+        if len(rows) > self.max_rows:
+            return
+        if tables is None:
+            tables = read_tables(sql)
+        key = self.key(sql, params)
+        now = time.time()
+        if started is None:
+            started = now
+        entry = (started, now + self.ttl, tuple(tables), description,
+                 tuple(rows))
+
+        self.lock.acquire()
+        try:
+            for table in list(tables) + ['*']:
+                if self.invalidated.get(table, 0) >= started:
+                    return
+            self.entries.pop(key, None)
+            self.__add(key, entry)
+            self.unpruned += 1
+            prune = self.unpruned >= max(1, self.max_size / 10)
+            if prune:
+                self.unpruned = 0
+        finally:
+            self.lock.release()
+        self.stats['stores'] += 1
+
+        if self.path is not None:
+            try:
+                data = _dump_entry(entry)
+            except ValueError:
+                data = None
+            if data is not None:
+                filename = self.__file(key)
+                temporary = '%s.%d.%d' % (filename, os.getpid(),
+                                          threading.currentThread().ident)
+                f = open(temporary, 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                os.rename(temporary, filename)
+            if prune:
+                self.prune()
+
+    def prune(self):
+        """
+        Deletes from path the files of expired results, and the oldest
+        ones beyond max_size
+        """
+        if self.path is None:
+            return
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.entry'):
+                filename = os.path.join(self.path, name)
+                try:
+                    files.append((os.path.getmtime(filename), filename))
+                except OSError:
+                    pass
+        files.sort()
+        expired = time.time() - self.ttl
+        excess = len(files) - self.max_size
+        for i in range(len(files)):
+            modified, filename = files[i]
+            if modified >= expired and i >= excess:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def __add(self, key, entry):
+        self.entries[key] = entry
+        for table in entry[2]:
+            self.tables.setdefault(table, set()).add(key)
+        while len(self.entries) > self.max_size:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.__unindex(old_key, old_entry)
+
+    def __unindex(self, key, entry):
+        for table in entry[2]:
+            keys = self.tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tables[table]
+
+    def __write_stamp(self, table):
+        filename = self.__stamp_file(table)
+        temporary = '%s.%d' % (filename, os.getpid())
+        f = open(temporary, 'w')
+        try:
+            f.write(repr(time.time()))
+        finally:
+            f.close()
+        os.rename(temporary, filename)
+
+    def invalidate(self, tables):
+        """
+        Drops the cached results that read any of the given tables
+        """
+        tables = [table.lower() for table in tables]
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for table in tables:
+                self.invalidated[table] = now
+                for key in self.tables.pop(table, ()):
+                    entry = self.entries.pop(key, None)
+                    if entry is not None:
+                        self.__unindex(key, entry)
+        finally:
+            self.lock.release()
+        self.stats['invalidations'] += 1
+        if self.path is not None:
+            for table in tables:
+                self.__write_stamp(table)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.invalidated['*'] = time.time()
+            self.entries.clear()
+            self.tables.clear()
+        finally:
+            self.lock.release()
+        if self.path is not None:
+            self.__write_stamp('*')
+
+# Cache used by DbQuery when none is given. Caching is off until it is set
+# to a QueryCache.
+default_cache = None
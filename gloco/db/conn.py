@@ -28,13 +28,151 @@ gloco/db/connection.py
    Database connection module
 """
 
-__all__ = ['DbConn']
+__all__ = ['DbConn', 'ReplicaSelector', 'get_selector', 'is_read',
+           'ThreadConnections', 'default_connections', 'commit_listeners']
+
+import re
+import time
+import thread
+import weakref
+import threading
 
 from gloco.db import * 
 
+__read = re.compile(r'^\s*\(?\s*(SELECT|SHOW|DESCRIBE|DESC|EXPLAIN)\b', re.I)
+__locking = re.compile(r'\b(FOR\s+UPDATE|LOCK\s+IN\s+SHARE\s+MODE|'
+                       r'INTO\s+OUTFILE|GET_LOCK|RELEASE_LOCK)\b', re.I)
+__begin = re.compile(r'^\s*(BEGIN|START\s+TRANSACTION)\b', re.I)
+__end = re.compile(r'^\s*(COMMIT|ROLLBACK)\b', re.I)
+
+def is_read(sql):
+    """
+    Whether sql only reads, and so can be sent to a replica
+    """
+    return bool(__read.match(sql)) and not __locking.search(sql)
+
+def is_begin(sql):
+    return bool(__begin.match(sql))
+
+def is_end(sql):
+    return bool(__end.match(sql))
+
+# MySQL client errors meaning the server can't be reached or the connection
+# was lost: CR_CONNECTION_ERROR, CR_CONN_HOST_ERROR, CR_SERVER_GONE_ERROR
+# and CR_SERVER_LOST
+CONNECTION_ERRORS = (2002, 2003, 2006, 2013)
+
+# Functions called with a DbConn after each commit or rollback through it,
+# such as the invalidation of query caches
+commit_listeners = []
+
+class ReplicaSelector:
+    """
+    Keeps track of the health of a set of replicas, and chooses the one
+    each read is sent to.
+
+    With the 'round-robin' policy, reads take turns on the healthy
+    replicas; with 'least-latency', they go to the one that has answered
+    fastest, as an exponentially weighted moving average. A replica that
+    fails failure_threshold times in a row is skipped for cooldown seconds.
+    Replicas are known by their position in the list of replicas.
+    """
+    def __init__(self, count, policy='round-robin', failure_threshold=3,
+                 cooldown=30, weight=0.3):
+        if policy not in ('round-robin', 'least-latency'):
+            raise ValueError, 'unknown read policy: %s' % policy
+        self.replicas = range(count)
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.weight = weight
+
+        self.lock = threading.Lock()
+        self.turn = 0
+        self.latency = [0.0] * count
+        self.failures = [0] * count
+        self.broken_until = [0] * count
+
+    def ordered(self):
+        """
+        Returns the replicas in the order they should be tried: healthy
+        ones by policy, then broken ones, by how soon they will be tried
+        again
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            healthy = [i for i in self.replicas if self.broken_until[i] <= now]
+            broken = [(self.broken_until[i], i) for i in self.replicas
+                      if self.broken_until[i] > now]
+            if self.policy == 'least-latency':
+                healthy.sort(key=lambda i: self.latency[i])
+            elif healthy:
+                start = self.turn % len(healthy)
+                healthy = healthy[start:] + healthy[:start]
+                self.turn += 1
+        finally:
+            self.lock.release()
+        broken.sort()
+        return healthy + [i for until, i in broken]
+
+    def record_success(self, replica, latency):
+        self.lock.acquire()
+        try:
+            if self.latency[replica]:
+                self.latency[replica] += self.weight * \
+                                         (latency - self.latency[replica])
+            else:
+                self.latency[replica] = latency
+            self.failures[replica] = 0
+            self.broken_until[replica] = 0
+        finally:
+            self.lock.release()
+
+    def record_failure(self, replica):
+        self.lock.acquire()
+        try:
+            self.failures[replica] += 1
+            if self.failures[replica] >= self.failure_threshold:
+                self.broken_until[replica] = time.time() + self.cooldown
+        finally:
+            self.lock.release()
+
+# Replica selectors shared by all DbConn instances, keyed by the replicas
+selectors = {}
+selectors_lock = threading.Lock()
+
+def get_selector(replicas, **kwargs):
+    """
+    Returns the replica selector for a list of replica configurations,
+    creating it on first use. kwargs are passed to ReplicaSelector when the
+    selector is created.
+    """
+    key = tuple([(config.get('host'), config.get('db'), config.get('user'))
+                 for config in replicas])
+    selectors_lock.acquire()
+    try:
+        if not selectors.has_key(key):
+            selectors[key] = ReplicaSelector(len(replicas), **kwargs)
+        return selectors[key]
+    finally:
+        selectors_lock.release()
+
 class DbConn(object):
     """
     A Database Connection.
+
+    If the configuration lists replicas, execute() sends reads to one of
+    them and everything else to the primary server (see
+    default_db_config). Each DbConn connects to the replica the selector
+    picks when it first reads, so with the round-robin policy successive
+    connections take turns. Reads also go to the primary inside transactions,
+    started with BEGIN or START TRANSACTION or by any write and ended by
+    commit or rollback, and for sticky seconds after a write, so that the
+    writes of this connection are seen even if the replicas lag behind. A
+    read that fails because the replica can't be reached is retried on the
+    other replicas, and on the primary as a last resort; other errors are
+    raised at once.
     """
 
     global default_db_config
@@ -49,6 +187,33 @@ class DbConn(object):
             
         self.real_driver = __import__(python_module)
 
+        self.replicas = [self.__replica_config(replica)
+                         for replica in config.get('replicas', [])]
+        self.sticky = config.get('sticky', 0)
+        self.real_replica_conn = None
+        self.replica = None
+        self.cursors = {}
+        self.in_transaction = False
+        self.last_write = 0
+        if self.replicas:
+            policy = config.get('read_policy', 'round-robin')
+            self.selector = get_selector(self.replicas, policy=policy)
+
+    def __replica_config(self, replica):
+        config = dict(self.config)
+        config.pop('replicas', None)
+        if isinstance(replica, basestring):
+            config['host'] = replica
+        else:
+            config.update(replica)
+        return config
+
+    def __connect(self, config):
+        return self.real_driver.connect(host = config['host'],
+                                        user = config['user'],
+                                        passwd = config['passwd'],
+                                        db = config['db'])
+
     def connect(self, host=None, user=None, passwd=None, db=None):
         """
         Connects to the database. The real connection object, as created
@@ -76,6 +241,281 @@ class DbConn(object):
         except:
             return False
 
+    def connect_replica(self, exclude=()):
+        """
+        Connects to a replica, chosen by the replica selector among those
+        not in exclude. The connection is stored in self.real_replica_conn,
+        and the position of the replica in self.replica.
+
+        It returns True if the connection suceeds and False otherwise.
+        """
+        self.close_replica()
+        for replica in self.selector.ordered():
+            if replica in exclude:
+                continue
+            start = time.time()
+            try:
+                self.real_replica_conn = self.__connect(self.replicas[replica])
+            except Exception:
+                self.selector.record_failure(replica)
+                continue
+            self.selector.record_success(replica, time.time() - start)
+            self.replica = replica
+            return True
+        return False
+
+    def close_replica(self):
+        if self.real_replica_conn is not None:
+            self.cursors.pop(self.real_replica_conn, None)
+            try:
+                self.real_replica_conn.close()
+            except Exception:
+                pass
+        self.real_replica_conn = None
+        self.replica = None
+
+    def cursor(self, conn=None, cursors=None):
+        """
+        Returns the cursor used on a connection, by default the primary one.
+        Cursors are kept in cursors, a dictionary, so that each user of the
+        connection can have its own, or in self.cursors if not given.
+        """
+        if conn is None:
+            conn = self.real_conn
+        if cursors is None:
+            cursors = self.cursors
+        if not cursors.has_key(conn):
+            cursors[conn] = conn.cursor()
+        return cursors[conn]
+
+    def server_cursor(self, conn=None):
+        """
+        Returns a new cursor on a connection, by default the primary one,
+        that leaves the result set on the server and fetches rows as they
+        are asked for (MySQLdb's SSCursor). Drivers without such cursors
+        give a regular one. The caller must close it, and the connection
+        can't run other statements until it is.
+        """
+        if conn is None:
+            conn = self.real_conn
+        try:
+            cursors = __import__(self.real_driver.__name__ + '.cursors',
+                                 {}, {}, ['SSCursor'])
+            return conn.cursor(cursors.SSCursor)
+        except (ImportError, AttributeError):
+            return conn.cursor()
+
+    def use_replica(self, sql):
+        """
+        Whether sql should be sent to a replica. Keeps track of transactions
+        and writes as a side effect.
+        """
+        if is_begin(sql):
+            self.in_transaction = True
+        elif is_end(sql):
+            self.in_transaction = False
+            return False
+        if not is_read(sql):
+            # Without autocommit a write starts a transaction, whose
+            # uncommitted changes only the primary can see
+            self.in_transaction = True
+            self.last_write = time.time()
+            return False
+        return bool(self.replicas) and not self.in_transaction and \
+               time.time() - self.last_write >= self.sticky
+
+    def execute(self, sql, params=None, cursors=None, server_side=False):
+        """
+        Executes sql on the primary server or on a replica, and returns the
+        cursor used (see cursor() for cursors). With server_side set, a new
+        cursor from server_cursor() is used instead, which the caller must
+        close.
+        """
+        if server_side:
+            get_cursor = lambda conn, cursors: self.server_cursor(conn)
+        else:
+            get_cursor = self.cursor
+        if self.use_replica(sql):
+            failed = set()
+            for attempt in self.replicas:
+                if self.real_replica_conn is None and \
+                        not self.connect_replica(failed):
+                    break
+                cursor = get_cursor(self.real_replica_conn, cursors)
+                start = time.time()
+                try:
+                    cursor.execute(sql, params)
+                except Exception, e:
+                    if not self.__is_down(e):
+                        raise
+                    failed.add(self.replica)
+                    self.selector.record_failure(self.replica)
+                    self.close_replica()
+                    continue
+                self.selector.record_success(self.replica,
+                                             time.time() - start)
+                return cursor
+        cursor = get_cursor(None, cursors)
+        cursor.execute(sql, params)
+        if is_end(sql):
+            self.__ended()
+        return cursor
+
+    def __is_down(self, error):
+        """
+        Whether error means the server can't be reached, rather than
+        something wrong with the statement
+        """
+        interface = getattr(self.real_driver, 'InterfaceError', None)
+        if interface is not None and isinstance(error, interface):
+            return True
+        operational = getattr(self.real_driver, 'OperationalError', None)
+        return operational is not None and \
+               isinstance(error, operational) and \
+               bool(error.args) and error.args[0] in CONNECTION_ERRORS
+
+    def __ended(self):
+        for listener in commit_listeners:
+            listener(self)
+
+    def commit(self):
+        self.in_transaction = False
+        self.real_conn.commit()
+        self.__ended()
+
+    def rollback(self):
+        self.in_transaction = False
+        self.real_conn.rollback()
+        self.__ended()
+
+    def close(self):
+        """
+        Closes the connections to the primary server and to the replica
+        """
+        self.close_replica()
+        self.cursors.clear()
+        try:
+            self.real_conn.close()
+        except Exception:
+            pass
+
+class _ThreadConn:
+    """
+    Holds the connection of one thread, closing it when the thread is gone
+    """
+    def __init__(self, manager, conn):
+        self.manager = manager
+        self.conn = conn
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            conn.close()
+            self.manager._released()
+
+    def __del__(self):
+        self.close()
+
+class ThreadConnections:
+    """
+    Gives each thread a DbConn of its own, so that threads never share a
+    DB-API connection and don't have to take turns on one.
+
+    A thread's connection is opened the first time it calls get(), reused
+    by its later calls, and closed when the thread exits or calls
+    release(). No more than max_connections are open at once; get() then
+    waits for another thread to give its connection back, and raises the
+    driver's OperationalError if none is after timeout seconds.
+    """
+    def __init__(self, config=default_db_config, max_connections=None,
+                 timeout=None):
+        self.config = config
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.size = 0
+        # thread id -> _ThreadConn, kept alive by the thread's local data
+        self.holders = weakref.WeakValueDictionary()
+
+    def __error(self, conn, message):
+        error = getattr(conn.real_driver, 'OperationalError', RuntimeError)
+        return error(message)
+
+    def __reserve(self, conn):
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        self.condition.acquire()
+        try:
+            while self.max_connections and \
+                    self.size >= self.max_connections:
+                if self.timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise self.__error(conn, 'too many connections')
+                    self.condition.wait(remaining)
+            self.size += 1
+        finally:
+            self.condition.release()
+
+    def _released(self):
+        self.condition.acquire()
+        try:
+            self.size -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def get(self):
+        """
+        Returns the connection of the calling thread, opening it if needed
+        """
+        holder = getattr(self.local, 'holder', None)
+        if holder is not None and holder.conn is not None:
+            return holder.conn
+
+        conn = DbConn(self.config)
+        self.__reserve(conn)
+        if not conn.connect():
+            self._released()
+            raise self.__error(conn, 'could not connect to %s' %
+                               self.config['host'])
+        holder = _ThreadConn(self, conn)
+        self.local.holder = holder
+        self.holders[thread.get_ident()] = holder
+        return conn
+
+    def release(self):
+        """
+        Closes the connection of the calling thread, making room for
+        another one
+        """
+        holder = getattr(self.local, 'holder', None)
+        if holder is not None:
+            self.local.holder = None
+            holder.close()
+
+    def close_all(self):
+        """
+        Closes the connections of all threads. Meant for shutdown, as it
+        does not wait for the threads to be done with them.
+        """
+        for holder in self.holders.values():
+            holder.close()
+
+    def count(self):
+        """
+        Returns how many connections are open
+        """
+        return self.size
+
+# Thread connections for the default configuration, as in
+# DbQuery(conn=default_connections)
+default_connections = ThreadConnections()
+
 if __name__ == '__main__':
     conn = DbConn()
     if conn.connect():
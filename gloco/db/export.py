@@ -0,0 +1,319 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2005 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+gloco/db/export.py
+
+   streaming export of query results
+
+   Rows are read from the cursor a chunk at a time, encoded and written
+   out before the next chunk is read, so memory use depends on the
+   chunk size, not on the size of the result set, as long as the cursor
+   does not buffer the whole result set itself. The default MySQLdb
+   cursor does; DbQuery.export() uses a server-side cursor instead.
+   The formats are:
+
+   csv       a header line with the column names, then one line per row
+   jsonl     one JSON object per row
+   columnar  a compact binary format, with the values of each column
+             stored together, chunk by chunk (see read_columnar)
+
+   With compress set to a level from 1 to 9, each chunk is compressed as
+   a gzip member of its own. The members together form a regular gzip
+   file, and the chunks can be encoded and compressed by several threads
+   at once.
+"""
+
+__all__ = ['export', 'read_columnar', 'FORMATS']
+
+import csv
+import zlib
+import json
+import struct
+import threading
+from time import time
+from cStringIO import StringIO
+
+COLUMNAR_MAGIC = 'GLCOL1\n'
+
+def __text(value):
+    if type(value) is unicode:
+        return value.encode('utf-8')
+    if type(value) is float:
+        # str() rounds to 12 significant digits
+        return repr(value)
+    return str(value)
+
+def __encode_csv(names, rows, first):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    if first:
+        writer.writerow(names)
+    for row in rows:
+        writer.writerow([value is not None and __text(value) or ''
+                         for value in row])
+    return buf.getvalue()
+
+def __encode_jsonl(names, rows, first):
+    keys = [json.dumps(name) + ': ' for name in names]
+    lines = []
+    for row in rows:
+        fields = [key + json.dumps(value, default=str)
+                  for key, value in zip(keys, row)]
+        lines.append('{' + ', '.join(fields) + '}\n')
+    return ''.join(lines)
+
+def __encode_column(values):
+    """
+    Encodes the values of one column of a chunk: a type code, a null
+    bitmap and the values, as 64 bit integers, doubles or length
+    prefixed UTF-8 strings. Integers are only mixed with floats as
+    doubles if they fit in the 53 bits of a double, and only stored as
+    integers if they fit in 64 bits; otherwise the column is stored as
+    strings, so that no digits are lost.
+    """
+    n = len(values)
+    present = [value for value in values if value is not None]
+    kinds = set([type(value) for value in present])
+    integers = [value for value in present if type(value) in (int, long)]
+    if integers:
+        low, high = min(integers), max(integers)
+    else:
+        low = high = 0
+    if not present:
+        kind = 'n'
+    elif kinds <= set([int, long, bool]) and -2**63 <= low and high < 2**63:
+        kind = 'i'
+    elif kinds <= set([int, long, bool, float]) and \
+            -2**53 <= low and high <= 2**53:
+        kind = 'f'
+    else:
+        kind = 's'
+
+    nulls = bytearray((n + 7) / 8)
+    for i in xrange(n):
+        if values[i] is None:
+            nulls[i / 8] |= 1 << (i % 8)
+    parts = [kind, str(nulls)]
+
+    if kind == 'i':
+        parts.append(struct.pack('<%dq' % n,
+                                 *[value or 0 for value in values]))
+    elif kind == 'f':
+        parts.append(struct.pack('<%dd' % n,
+                                 *[value or 0.0 for value in values]))
+    elif kind == 's':
+        texts = [value is not None and __text(value) or ''
+                 for value in values]
+        parts.append(struct.pack('<%dI' % n, *[len(t) for t in texts]))
+        parts.extend(texts)
+    return ''.join(parts)
+
+def __encode_columnar(names, rows, first):
+    parts = []
+    if first:
+        parts.append(COLUMNAR_MAGIC)
+        parts.append(struct.pack('<H', len(names)))
+        for name in names:
+            name = __text(name)
+            parts.append(struct.pack('<H', len(name)) + name)
+    if rows:
+        parts.append(struct.pack('<I', len(rows)))
+        for values in zip(*rows):
+            parts.append(__encode_column(values))
+    return ''.join(parts)
+
+FORMATS = {'csv' : __encode_csv,
+           'jsonl' : __encode_jsonl,
+           'columnar' : __encode_columnar}
+
+def __compress(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class __Chunk(threading.Thread):
+    """
+    Encodes (and compresses) one chunk of rows in a thread of its own
+    """
+    def __init__(self, encode, names, rows, first, level):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.args = (encode, names, rows, first, level)
+        self.data = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.data = _encode_chunk(*self.args)
+        except Exception, e:
+            self.error = e
+
+def _encode_chunk(encode, names, rows, first, level):
+    data = encode(names, rows, first)
+    if level:
+        data = __compress(data, level)
+    return data
+
+def export(cursor, out, format='csv', chunk=10000, compress=0, workers=0,
+           progress=None):
+    """
+    Writes the rows of an executed query to out, a file name or a file
+    like object, in the given format (see FORMATS)
+
+    Rows are fetched chunk rows at a time. If compress is a level from 1
+    to 9, the output is gzip compressed. If workers is more than 0, up to
+    that many chunks are encoded by separate threads while the next ones
+    are fetched; they are still written in order. If given, progress is
+    called with the stats after each chunk is written.
+
+    Returns the stats: a dictionary with the number of rows, chunks and
+    bytes written, and the seconds it took.
+    """
+    if not FORMATS.has_key(format):
+        raise ValueError, 'unknown export format: %s' % format
+    encode = FORMATS[format]
+    names = [column[0] for column in cursor.description]
+
+    close = False
+    if isinstance(out, basestring):
+        out = open(out, 'wb')
+        close = True
+
+    stats = {'rows' : 0, 'chunks' : 0, 'bytes' : 0, 'seconds' : 0.0}
+    start = time()
+
+    def write(data, rows):
+        out.write(data)
+        stats['rows'] += rows
+        stats['chunks'] += 1
+        stats['bytes'] += len(data)
+        stats['seconds'] = time() - start
+        if progress is not None:
+            progress(stats)
+
+    def finish(job):
+        job.join()
+        if job.error is not None:
+            raise job.error
+        write(job.data, len(job.args[2]))
+
+    pending = []
+    try:
+        first = True
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows and not first:
+                break
+            if workers:
+                job = __Chunk(encode, names, rows, first, compress)
+                job.start()
+                pending.append(job)
+                if len(pending) > workers:
+                    finish(pending.pop(0))
+            else:
+                write(_encode_chunk(encode, names, rows, first, compress),
+                      len(rows))
+            first = False
+            if not rows:
+                break
+        while pending:
+            finish(pending.pop(0))
+    finally:
+        for job in pending:
+            job.join()
+        if close:
+            out.close()
+    return stats
+
+def __read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError, 'truncated columnar file'
+    return data
+
+def __decode_column(f, n):
+    kind = __read(f, 1)
+    nulls = bytearray(__read(f, (n + 7) / 8))
+    if kind == 'n':
+        return [None] * n
+    if kind == 'i':
+        values = list(struct.unpack('<%dq' % n, __read(f, 8 * n)))
+    elif kind == 'f':
+        values = list(struct.unpack('<%dd' % n, __read(f, 8 * n)))
+    elif kind == 's':
+        lengths = struct.unpack('<%dI' % n, __read(f, 4 * n))
+        data = __read(f, sum(lengths))
+        values = []
+        offset = 0
+        for length in lengths:
+            values.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+    else:
+        raise ValueError, 'unknown column type: %r' % kind
+    for i in xrange(n):
+        if nulls[i / 8] & (1 << (i % 8)):
+            values[i] = None
+    return values
+
+def read_columnar(f):
+    """
+    Reads a file written by export() in the columnar format, yielding the
+    column names first and then each row as a tuple. f is a file name or
+    a file like object; gzip compressed files are detected by their
+    header.
+    """
+    if isinstance(f, basestring):
+        f = open(f, 'rb')
+    magic = f.read(2)
+    if magic == '\x1f\x8b':
+        import gzip
+        f.seek(0)
+        f = gzip.GzipFile(fileobj=f)
+        magic = ''
+    magic += f.read(len(COLUMNAR_MAGIC) - len(magic))
+    if magic != COLUMNAR_MAGIC:
+        raise ValueError, 'not a columnar export file'
+
+    names = []
+    for i in xrange(struct.unpack('<H', __read(f, 2))[0]):
+        size = struct.unpack('<H', __read(f, 2))[0]
+        names.append(__read(f, size).decode('utf-8'))
+    yield tuple(names)
+
+    while True:
+        header = f.read(4)
+        if not header:
+            break
+        n = struct.unpack('<I', header)[0]
+        columns = [__decode_column(f, n) for name in names]
+        for row in zip(*columns):
+            yield row
+
+if __name__ == '__main__':
+    import sys
+    from gloco.db.query import DbQuery
+    from gloco.db import default_db_config
+
+    default_db_config['db'] = 'test'
+    print DbQuery().export(sys.stdout, 'csv', sys.argv[1])
@@ -30,28 +30,122 @@ gloco/db/query.py
 
 __all__ = ['DbQuery']
 
-from conn import DbConn
+import time
 
-from gloco.ext.db.resultset import getdict
+from conn import DbConn, ThreadConnections
+import cache
+
+from gloco.ext.db.resultset import getdict, ResultRow
 
 class DbQuery:
     """
     Simple class that performs a database query.
+
+    If a QueryCache is given (or set as gloco.db.cache.default_cache),
+    the results of SELECT queries are served from it when possible, and
+    self.cursor is then a CachedCursor. Writes drop the cached results of
+    the tables they write to, and again when the connection commits.
+
+    Queries are run through a DbConn, which may send reads to replicas.
+    Passing the same conn to several DbQuery instances makes them share
+    its connections and its read-your-writes stickiness. conn can also be
+    a ThreadConnections, to use the connection of the calling thread.
     """
-    def __init__(self, sql=None):
-        cnc = DbConn()
-        cnc.connect()
-        self.cursor = cnc.real_conn.cursor()
+    def __init__(self, sql=None, cache=None, conn=None):
+        if conn is None:
+            conn = DbConn()
+            conn.connect()
+        elif isinstance(conn, ThreadConnections):
+            conn = conn.get()
+        self.conn = conn
+        self.cursors = {}
+        self.real_cursor = self.cursor = conn.cursor(cursors=self.cursors)
+        self.cache = cache
+        self.query = None
+        self.params = None
 
         if sql:
             self.execute(sql)
 
     def execute(self, query, params=None):
-        self.cursor.execute(query, params)
+        self.query = query
+        self.params = params
+        query_cache = self.cache
+        if query_cache is None:
+            query_cache = cache.default_cache
+        # While the connection has uncommitted writes, its reads see rows
+        # other connections must not get from the cache
+        cacheable = query_cache is not None and \
+                    cache.is_cacheable(query) and \
+                    not self.conn.in_transaction and \
+                    not cache.has_uncommitted(self.conn)
+
+        if cacheable:
+            result = query_cache.lookup(query, params)
+            if result is not None:
+                self.cursor = cache.CachedCursor(*result)
+                return
+
+        started = time.time()
+        self.real_cursor = self.cursor = self.conn.execute(query, params,
+                                                            self.cursors)
+
+        if cacheable:
+            # Results too big for the cache are not fetched whole, the
+            # rows read so far are handed out before the rest
+            rows = self.cursor.fetchmany(query_cache.max_rows + 1)
+            if len(rows) <= query_cache.max_rows:
+                query_cache.store(query, params, self.cursor.description,
+                                  rows, started=started)
+                self.cursor = cache.CachedCursor(self.cursor.description,
+                                                 rows)
+            else:
+                self.cursor = cache.CachedCursor(self.cursor.description,
+                                                 rows, self.real_cursor)
+        else:
+            tables = cache.written_tables(query)
+            if tables is None or tables:
+                cache.written(tables, self.conn)
 
     def fetchdict(self):
         return getdict(self.cursor.fetchall(), self.cursor.description)
 
+    def iterdict(self, size=1000):
+        """
+        Like fetchdict, but yields the ResultRow objects as they are
+        fetched, size rows at a time
+        """
+        fields = {}
+        for i in range(len(self.cursor.description)):
+            fields[self.cursor.description[i][0]] = i
+        while True:
+            rows = self.cursor.fetchmany(size)
+            if not rows:
+                break
+            for row in rows:
+                yield ResultRow(row, fields)
+
+    def export(self, out, format='csv', query=None, params=None, **kwargs):
+        """
+        Streams the rows of a query, by default the last one executed, to
+        out, a file name or a file like object. See gloco.db.export.export
+        for the formats and other options.
+
+        The query is run on a server-side cursor, bypassing the query
+        cache, so rows are only fetched from the server as they are
+        written out, and memory use does not grow with the result set.
+        """
+        from gloco.db.export import export
+        if query is None:
+            if self.query is None:
+                raise ValueError, 'no query to export'
+            query, params = self.query, self.params
+        cursor = self.conn.execute(query, params, server_side=True)
+        try:
+            return export(cursor, out, format, **kwargs)
+        finally:
+            cursor.close()
+
 if __name__ == '__main__':
     from gloco.db import default_db_config
 
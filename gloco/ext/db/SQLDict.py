@@ -46,6 +46,26 @@ retrieve information:
 Note that the [] (__getitem__) operation returns a special cursor
 with some extended properties; more on that latter.
 
+The cursor can also be iterated over, which fetches and loads the rows
+a batch at a time, so big result sets do not have to fit in memory:
+
+>>> for person in db.People.loc['Cleveland','OH']:
+...     print person
+
+Pass server_side=1 to Table() (or select()) to also keep the rows on the
+database server until they are fetched.
+
+Wide columns don't have to be fetched with every row. Columns listed
+in deferred (and the columns left out by an index select() with a
+columns argument) are loaded the first time they are accessed, for
+all the objects of the same select at once. This needs a primary_key:
+
+>>> class Person(ObjectBuilder):
+...     primary_key = ['Name']
+...     deferred = ['Biography']
+...
+>>> names = db.People.loc.select(('Cleveland','OH'), columns=['Name'])
+
 >>> db.People.loc = db.Index(('City','State'))
 >>> db.People.loc['Cleveland','OH'].fetchall()
 [('Bob Dobbs', '42 Slack Ln', 'Cleveland', 'OH')
@@ -88,6 +108,9 @@ register(db) method creates the table and index members in db. Of course,
 you can add your own methods and such. If you need an __init__ method,
 make sure you call apply(ObjectBuilder.__init__, (self,)+args, kwargs)
 at some point.
+Objects loaded from the database skip the constructor and get their
+attributes set directly, which is much faster. Defining __init__ turns
+this off, and rows are then passed to your constructor instead.
 
 To reset the attributes from a dictionary:
 
@@ -116,6 +139,63 @@ Note that none of these methods ever commit any data to the database,
 so you will have to call db.commit() when appropriate, or otherwise
 set the transaction mode.
 
+When writing many rows, a session saves a round trip per row:
+
+>>> session = db.Session()
+>>> for p in people:
+...     db.People.Name[p.Name] = p
+>>> session.commit()
+>>> session.close()
+
+The writes are queued until commit, and then sent as executemany
+batches in one transaction. Updating the same key again before the
+commit only sends the last update. session.stats counts what was
+written.
+
+Big imports are much faster with bulk_load(), which uses COPY on
+PostgreSQL and LOAD DATA LOCAL INFILE with MySQLDict, and chunked
+executemany calls elsewhere:
+
+>>> stats = db.People.bulk_load(people, progress=report)
+>>> print stats['rows'], stats['rate']
+
+With db.Session(identity_map=1), loading the same row again, through
+any index, gives back the same object, provided the table was defined
+with a primary_key. session.changed() lists the loaded objects that
+were modified, and session.save_changed() queues updates for them.
+
+Indices also do range scans, in index order:
+
+>>> db.People.Name.between('A', 'C').fetchall()
+>>> db.People.Name.range(low='Bob', exclude_low=1, reverse=1, limit=10)
+
+To page through a big table, page() returns the key of the last item
+along with the page, and the next page starts right after it. Unlike
+OFFSET, this costs the same however deep the page is. scan() does the
+paging for you:
+
+>>> page, after = db.People.Name.page(size=100)
+>>> page, after = db.People.Name.page(after, size=100)
+>>> for person in db.People.loc.scan(low=('Cleveland',)):
+...     print person
+
+Small lookup tables can be kept entirely in memory. Index lookups are
+then answered from hash tables, without touching the database:
+
+>>> db.States.replicate(refresh=300)
+>>> db.States.code['OH'].fetchone()
+
+The copy is loaded again every refresh seconds, after writes through
+the table, or when db.States.refresh() is called. Setting replica = 1
+on an ObjectBuilder does the same.
+
+If the table has a column that grows with every write, such as an
+update time, only the rows changed since the last load are fetched.
+Rows deleted by others are noticed if they are kept as tombstones,
+flagged by a deleted column:
+
+>>> db.Items.replicate(refresh=10, changed='Updated', deleted='Gone')
+
 Sub-queries: Suppose you want to do a sub-query, as in WHERE x IN (
 select-statement ) or some other kind of special query conditions. You
 can specify this with a WHERE parameter when creating the index. Note
@@ -129,7 +209,13 @@ available for doing weird things.
 
 __version__ = "$Id: SQLDict.py,v 1.2 1999/03/16 05:24:23 adustman Exp $"
 
+import weakref
+import threading
+from time import time
 from string import join
+from types import ClassType, UnicodeType, FloatType, BooleanType
+from cStringIO import StringIO
+from new import instance
 
 class SQLDict:
 
@@ -143,6 +229,9 @@ class SQLDict:
 
 	# Most database objects are native C, so they can't be subclassed.
 	self.db = db
+	self.session = None
+	# Tables written through this object since the last commit
+	self.uncommitted = {}
 
     def __del__(self):	self.close()
 
@@ -150,18 +239,198 @@ class SQLDict:
 	try: self.db.close()
 	except: pass
 
+    def commit(self):
+	"""Commit, and tell the write listeners again about the
+	tables written since the last commit, as other connections
+	may have read them in between."""
+	self.db.commit()
+	tables, self.uncommitted = self.uncommitted, {}
+	for table in tables.keys(): _written(table)
+
+    def rollback(self):
+	self.uncommitted = {}
+	self.db.rollback()
+
     def __getattr__(self, attr):
 	# Get any other interesting attributes from the base class.
 	return getattr(self.db, attr)
 
 
+    class _Session:
+
+	"""Unit of work for a SQLDict object. These should not be created
+	directly by user code. Use the Session method of SQLDict instead.
+
+	While a session is open, inserts, updates and deletes done through
+	the tables of the SQLDict are queued instead of executed. Queued
+	statements are executed in the order they were issued, but runs
+	of the same statement go to the database in a single executemany
+	call. Within such a run, repeated updates or deletes of the same
+	key only keep the last one.
+
+	With identity_map set, a row loaded more than once from a table
+	with a primary_key gives the same object every time, as long as
+	that object is in use somewhere. The row each object was loaded
+	from is remembered, so changed() can tell which objects were
+	modified without asking the database."""
+
+	def __init__(self, sqldict, identity_map=0):
+	    self.sqldict = sqldict
+	    self.runs = []
+	    # (table, columns, key values) -> (weakref, row, _Table)
+	    if identity_map: self.identity = {}
+	    else: self.identity = None
+	    self.tables = {}
+	    self.stats = {'flushes': 0,
+			  'statements': 0,
+			  'rows': 0,
+			  'coalesced': 0}
+
+	def add(self, statement, params, key=None, table=None):
+	    """Queue a statement with its parameters. If key is given,
+	    it replaces a statement with the same key in the current run
+	    of this statement. table is the name of the table written."""
+	    if table is not None: self.tables[table] = 1
+	    if self.runs and self.runs[-1][0] == statement:
+		run = self.runs[-1]
+	    else:
+		run = [statement, [], {}]
+		self.runs.append(run)
+	    statement, params_list, keys = run
+	    if key is not None and keys.has_key(key):
+		params_list[keys[key]] = params
+		self.stats['coalesced'] = self.stats['coalesced'] + 1
+	    else:
+		if key is not None: keys[key] = len(params_list)
+		params_list.append(params)
+
+	def pending(self):
+	    """Number of rows waiting to be written."""
+	    n = 0
+	    for statement, params_list, keys in self.runs:
+		n = n + len(params_list)
+	    return n
+
+	def flush(self):
+	    """Execute the queued statements, without committing."""
+	    if not self.runs: return
+	    c = self.sqldict.db.cursor()
+	    runs, self.runs = self.runs, []
+	    tables, self.tables = self.tables, {}
+	    for statement, params_list, keys in runs:
+		c.executemany(statement, params_list)
+		self.stats['statements'] = self.stats['statements'] + 1
+		self.stats['rows'] = self.stats['rows'] + len(params_list)
+	    self.stats['flushes'] = self.stats['flushes'] + 1
+	    for table in tables.keys(): _written(table, self.sqldict)
+
+	def commit(self):
+	    """Flush the queued statements and commit them in one
+	    transaction. If flushing fails, the transaction is rolled
+	    back."""
+	    try:
+		self.flush()
+	    except:
+		self.sqldict.rollback()
+		raise
+	    self.sqldict.commit()
+
+	def rollback(self):
+	    """Throw away the queued statements and roll back."""
+	    self.runs = []
+	    self.tables = {}
+	    self.sqldict.rollback()
+
+	def loader(self, table, columns=None, load=None):
+	    """Returns a load function for rows of the given columns of
+	    table (all of them by default) which goes through the
+	    identity map."""
+	    if load is None: load = table.load
+	    if columns is None: columns = table.columns
+	    columns = tuple(columns)
+	    if self.identity is None or not table.primary_key: return load
+	    positions = map(list(columns).index, table.primary_key)
+	    name = (table.table, tuple(table.columns))
+	    identity = self.identity
+	    forget = self._forget
+
+	    def identity_load(row):
+		key = (name, tuple(map(row.__getitem__, positions)))
+		entry = identity.get(key)
+		if entry is not None:
+		    obj = entry[0]()
+		    if obj is not None: return obj
+		obj = load(row)
+		try:
+		    ref = weakref.ref(obj, lambda ref, key=key: forget(key, ref))
+		except TypeError:
+		    # Objects such as plain tuples can't be weakly referenced
+		    return obj
+		identity[key] = (ref, (columns, tuple(row)), table)
+		return obj
+	    return identity_load
+
+	def _forget(self, key, ref):
+	    entry = self.identity.get(key)
+	    if entry is not None and entry[0] is ref: del self.identity[key]
+
+	def changed(self):
+	    """Returns a list of (table, object) for the objects in the
+	    identity map that changed since they were loaded."""
+	    l = []
+	    if self.identity is None: return l
+	    for ref, (columns, row), table in self.identity.values():
+		obj = ref()
+		if obj is not None and self._values(obj, columns) != row:
+		    l.append((table, obj))
+	    return l
+
+	def _values(self, obj, columns):
+	    return tuple(map(lambda c, obj=obj: getattr(obj, c), columns))
+
+	def save_changed(self):
+	    """Queue updates for the objects returned by changed(). Only
+	    the updatecolumns of their tables are written."""
+	    if self.identity is None: return
+	    for key, (ref, (columns, row), table) in self.identity.items():
+		obj = ref()
+		if obj is None: continue
+		values = self._values(obj, columns)
+		if values == row: continue
+		table._primary_key_index()[key[1]] = obj
+		self.identity[key] = (ref, (columns, values), table)
+
+	def close(self):
+	    """Stop queuing writes. Statements still queued are
+	    discarded, so commit first."""
+	    self.runs = []
+	    if self.identity is not None: self.identity.clear()
+	    if self.sqldict.session is self: self.sqldict.session = None
+
+
+    def Session(self, identity_map=0):
+
+	"""Start a unit of work session, and return it. Writes are
+	queued until session.commit() (or session.flush()) is called.
+	Selects flush the session first, so they see the queued writes.
+	session.close() goes back to executing writes immediately.
+
+	If identity_map is true, objects loaded during the session are
+	unique per row of tables that have a primary_key."""
+
+	self.session = self._Session(self, identity_map)
+	return self.session
+
+
 
     class _Table:
 
 	"""Table handler for a SQLDict object. These should not be created
 	directly by user code."""
 
-	def __init__(self, db, table, columns, updatecolumns=[]):
+	def __init__(self, db, table, columns, updatecolumns=[],
+		     server_side=0, sqldict=None, primary_key=None,
+		     deferred=None):
 
 	    """Construct a new table definition. Don't invoke this
 	    directly. Use Table method of SQLDict instead."""
@@ -169,8 +438,14 @@ class SQLDict:
 	    self.db = db
 	    self.table = table
 	    self.columns = columns
+	    self.server_side = server_side
+	    self.sqldict = sqldict
+	    self.primary_key = primary_key
+	    self.deferred = deferred or []
+	    self.loadcolumns = filter(lambda c, d=self.deferred: c not in d,
+				      columns)
 	    self.SELECT = "SELECT %s FROM %s " % \
-			  (self._columns(columns),
+			  (self._columns(self.loadcolumns),
 			   self.table)
 	    self.INSERT = "INSERT INTO %s (%s)\n    VALUES (%s) " % \
 			  (self.table,
@@ -193,7 +468,7 @@ class SQLDict:
 			   self._set(columns))
 	    self.updatecolumns = columns
 
-	def select(self, i=(), WHERE=''):
+	def select(self, i=(), WHERE='', server_side=None, columns=None):
 
 	    """Execute a SELECT command based on this Table and Index. The
 	    required argument i is a tuple containing the values to match
@@ -203,46 +478,559 @@ class SQLDict:
 	    (?) as there are values in i. Returns a _Cursor object for the
 	    matched rows.
 
+	    If server_side is true, the rows are kept on the server until
+	    they are fetched (see _Cursor). It defaults to the server_side
+	    setting of the Table.
+
+	    If columns is given, only those columns (plus the primary
+	    key) are selected. Columns that are not selected, either this
+	    way or because they are deferred, are loaded the first time
+	    they are accessed on the loaded objects (see _Deferred).
+
 	    Usually you don't need to call select() directly; this is done
 	    by the indexing operations (Index.__getitem__)."""
 
-	    c = self.cursor()
-	    if i: c.execute(self.SELECT+WHERE, i)
-	    else: c.execute(self.SELECT+WHERE)
+	    session = self._session()
+	    if session is not None: session.flush()
+	    if server_side is None: server_side = self.server_side
+
+	    columns, SELECT = self._select_columns(columns)
+	    if list(columns) == list(self.columns): load = self.load
+	    else: load = self._deferred_loader(columns)
+
+	    c = self.cursor(server_side)
+	    if session is not None: load = session.loader(self, columns, load)
+	    c.load = load
+	    if i: c.execute(SELECT+WHERE, i)
+	    else: c.execute(SELECT+WHERE)
 	    return c
 
+	def _select_columns(self, columns=None):
+	    """Returns the columns a select() with the given columns
+	    argument loads, and its SELECT statement."""
+	    if columns is None: return self.loadcolumns, self.SELECT
+	    columns = list(columns)
+	    for k in self.primary_key or []:
+		if k not in columns: columns.append(k)
+	    return columns, "SELECT %s FROM %s " % (self._columns(columns),
+						    self.table)
+
+	def _limit(self, n):
+	    """Returns the clause limiting a select to n rows. May be
+	    overridden for databases without LIMIT."""
+	    return "\n    LIMIT %d" % n
+
 	def insert(self, v):
 
 	    """Like select(), but performs an INSERT. Note that there is
 	    no WHERE clause on an INSERT."""
 
 	    from types import ListType
+	    if self.replica is not None: self.replica.invalidate()
+	    session = self._session()
+	    if session is not None:
+		if type(v) is ListType:
+		    for d in map(self.dump, v):
+			session.add(self.INSERT, d, table=self.table)
+		else:
+		    session.add(self.INSERT, self.dump(v), table=self.table)
+		return
 	    c = self.cursor()
 	    if type(v) is ListType:
 		d = map(self.dump, v)
 	    else:
 		d = self.dump(v)
 	    c.execute(self.INSERT, d)
+	    _written(self.table, self.sqldict)
 	    return c
 
-	def update(self, v, i=(), WHERE=''):
+	def update(self, v, i=(), WHERE='', coalesce=0):
 	    """Like select(), only it does an UPDATE. It is not usually
 	    necessary to call this method directly, as it is done by
-	    the indexing operations (Index.__setitem__)."""
-	    c = self.cursor()
+	    the indexing operations (Index.__setitem__).
+
+	    In a session, coalesce tells whether a later update with the
+	    same i may replace this one."""
 	    v0 = self.updatedump(v)
+	    if self.replica is not None: self.replica.invalidate()
+	    session = self._session()
+	    if session is not None:
+		if coalesce: key = i
+		else: key = None
+		session.add(self.UPDATE+WHERE, v0+i, key, self.table)
+		return
+	    c = self.cursor()
 	    c.execute(self.UPDATE+WHERE, v0+i)
+	    _written(self.table, self.sqldict)
 	    return c
 
 	def delete(self, i=(), WHERE=''):
 	    """Like select(), only it does an DELETE. It is not usually
 	    necessary to call this method directly, as it is done by
 	    the indexing operations (Index.__delitem__)."""
+	    if self.replica is not None: self.replica.invalidate(deleted=1)
+	    session = self._session()
+	    if session is not None:
+		session.add(self.DELETE+WHERE, i, i, self.table)
+		return
 	    c = self.cursor()
 	    if i: c.execute(self.DELETE+WHERE, i)
 	    else: c.execute(self.DELETE+WHERE)
+	    _written(self.table, self.sqldict)
 	    return c
 
+	# Number of rows sent to the database at a time by bulk_load()
+	bulk_chunk = 10000
+
+	def bulk_load(self, objects, chunk=None, progress=None):
+	    """Insert many objects much faster than insert() does, using
+	    the database's own bulk loader when there is one (see
+	    _bulk_native), and chunked executemany calls otherwise.
+
+	    objects can be any iterable, and is dumped and sent a chunk
+	    of rows at a time, so it does not need to fit in memory.
+	    If given, progress is called with the stats after each
+	    chunk. Returns the stats: a dictionary with the number of
+	    rows loaded, the seconds it took, the rows per second and
+	    the method used. Like insert(), this doesn't commit."""
+	    if self.replica is not None: self.replica.invalidate()
+	    session = self._session()
+	    if session is not None: session.flush()
+	    chunk = chunk or self.bulk_chunk
+	    stats = {'rows': 0, 'seconds': 0.0, 'rate': 0.0,
+		     'method': None}
+	    start = time()
+	    rows = []
+	    for obj in objects:
+		rows.append(self.dump(obj))
+		if len(rows) >= chunk:
+		    self._bulk_send(rows, stats, start, progress)
+		    rows = []
+	    if rows or not stats['rows']:
+		self._bulk_send(rows, stats, start, progress)
+	    _written(self.table, self.sqldict)
+	    return stats
+
+	def _bulk_send(self, rows, stats, start, progress):
+	    if rows:
+		if stats['method'] is None:
+		    # Only the first chunk may fall back, so that no
+		    # rows can be loaded twice
+		    try:
+			stats['method'] = self._bulk_native(rows)
+		    except Exception, e:
+			stats['error'] = str(e)
+		elif stats['method'] != 'executemany':
+		    self._bulk_native(rows)
+		if not stats['method'] or stats['method'] == 'executemany':
+		    stats['method'] = 'executemany'
+		    self.db.cursor().executemany(self.INSERT, rows)
+	    stats['rows'] = stats['rows'] + len(rows)
+	    stats['seconds'] = time() - start
+	    if stats['seconds']:
+		stats['rate'] = stats['rows'] / stats['seconds']
+	    if progress is not None: progress(stats)
+
+	def _bulk_native(self, rows):
+	    """Send rows with the database's bulk loader. Returns the
+	    name of the method used, or None if there is no bulk
+	    loader. This one uses COPY FROM STDIN where the cursors
+	    support it (psycopg2).
+
+	    A failed COPY aborts the transaction, so inside one it runs
+	    under a savepoint, which is rolled back on errors to leave
+	    the transaction usable by the executemany fallback."""
+	    c = self.db.cursor()
+	    if not hasattr(c, 'copy_expert'): return None
+	    savepoint = not getattr(self.db, 'autocommit', False)
+	    if savepoint: c.execute("SAVEPOINT sqldict_bulk_load")
+	    try:
+		c.copy_expert("COPY %s (%s) FROM STDIN" %
+			      (self.table, self._columns(self.columns)),
+			      StringIO(_bulk_text(rows)))
+	    except:
+		if savepoint:
+		    c.execute("ROLLBACK TO SAVEPOINT sqldict_bulk_load")
+		raise
+	    if savepoint: c.execute("RELEASE SAVEPOINT sqldict_bulk_load")
+	    return 'copy'
+
+	# Whether accessing a deferred column on one object loads that
+	# column for all the objects of the same select at once
+	deferred_batch = 1
+
+	# Maximum number of rows asked for by a single fetch_columns query
+	fetch_chunk = 500
+
+	def loader(self, columns):
+	    """Returns a load function for rows with only the given
+	    columns. May be overridden; the default passes the rows to
+	    load() unchanged."""
+	    return self.load
+
+	def _deferred_loader(self, columns):
+	    """Returns a load function for rows with only the given
+	    columns, which sets the loaded objects up to fetch the
+	    other columns on first access."""
+	    load = self.loader(columns)
+	    if not self.primary_key: return load
+	    add = self._Deferred(self).add
+	    def deferred_load(row, load=load, add=add):
+		return add(load(row))
+	    return deferred_load
+
+	def fetch_columns(self, objects, columns):
+	    """Load the given columns of objects from the database,
+	    looking them up by primary key."""
+	    pk = list(self.primary_key)
+	    n = len(pk)
+	    placeholder = self._values(pk[:1])
+	    by_key = {}
+	    for obj in objects:
+		key = tuple(map(lambda k, obj=obj: getattr(obj, k), pk))
+		by_key.setdefault(key, []).append(obj)
+
+	    keys = by_key.keys()
+	    c = self.db.cursor()
+	    for start in range(0, len(keys), self.fetch_chunk):
+		chunk = keys[start:start+self.fetch_chunk]
+		params = []
+		for key in chunk: params.extend(key)
+		if n == 1:
+		    WHERE = "%s IN (%s)" % (pk[0],
+					    join([placeholder]*len(chunk),
+						 ', '))
+		else:
+		    match = "(%s)" % join(map(lambda k, p=placeholder:
+					      "%s = %s" % (k, p), pk),
+					  ' AND ')
+		    WHERE = join([match]*len(chunk), ' OR ')
+		c.execute("SELECT %s FROM %s\n    WHERE %s" %
+			  (self._columns(pk+list(columns)), self.table,
+			   WHERE), tuple(params))
+		for row in c.fetchall():
+		    values = dict(zip(columns, row[n:]))
+		    for obj in by_key.pop(tuple(row[:n]), []):
+			obj._assign(values)
+
+	    # Rows that are gone from the database
+	    for objs in by_key.values():
+		for obj in objs: obj._assign({}.fromkeys(columns))
+
+	class _Deferred:
+
+	    """Keeps track of the objects loaded by one select that have
+	    columns left to load. When one of those columns is accessed
+	    on an ObjectBuilder object, it is fetched for that object,
+	    or for all of them if the table has deferred_batch set."""
+
+	    def __init__(self, table):
+		self.table = table
+		self.objects = []
+
+	    def add(self, obj):
+		"""Keep track of a newly loaded object. Returns the
+		object to use in its place, which may be a copy of it
+		that is able to load the remaining columns."""
+		try:
+		    obj.__dict__['_deferred'] = self
+		except AttributeError:
+		    return obj # not an object, nothing to load later
+		if isinstance(obj, ObjectBuilder):
+		    obj = _deferred_object(obj)
+		self.objects.append(weakref.ref(obj))
+		return obj
+
+	    def fetch(self, obj, column):
+		objects = [obj]
+		if self.table.deferred_batch:
+		    refs = []
+		    for ref in self.objects:
+			o = ref()
+			if o is None: continue
+			refs.append(ref)
+			if o is not obj and not o.__dict__.has_key(column):
+			    objects.append(o)
+		    self.objects = refs
+		self.table.fetch_columns(objects, [column])
+
+	# The in memory copy of the table, if any (see replicate())
+	replica = None
+
+	def replicate(self, refresh=None, changed=None, deleted=None):
+	    """Keep a copy of the whole table in memory, and serve
+	    Index lookups (Index.__getitem__) from it instead of the
+	    database. Meant for small tables that are read much more
+	    than they are written.
+
+	    The copy is loaded on the first lookup, and brought up to
+	    date when it is older than refresh seconds (if given), when
+	    refresh() is called, or after a write through this table.
+	    Lookups compare values with Python equality, not with the
+	    database's collation. Indices with a WHERE clause still go
+	    to the database. Set replica to None to stop replicating.
+
+	    If changed names a column that grows with every write (an
+	    update time, or an increasing version number), only the
+	    rows changed since the last load are fetched when bringing
+	    the copy up to date. Rows deleted by others are only
+	    noticed if they are kept around as tombstones: rows whose
+	    deleted column is true are left out of the copy. Needs a
+	    primary_key."""
+	    if changed and not self.primary_key:
+		raise ValueError, "incremental refresh needs a primary_key"
+	    self.replica = self._Replica(self, refresh, changed, deleted)
+	    return self.replica
+
+	def refresh(self, full=0):
+	    """Bring the in memory copy of the table up to date, now.
+	    If full is true, it is loaded all over again."""
+	    if self.replica is None: return
+	    if full: self.replica.load()
+	    else: self.replica.update()
+
+	def _indices(self):
+	    """Returns the indices defined as members of this table."""
+	    return filter(lambda v, I=SQLDict._Table._Index:
+			  isinstance(v, I), self.__dict__.values())
+
+	class _Replica:
+
+	    """All the rows of a table, held in memory, with a hash
+	    index per Index of the table. Lookups return a cursor-like
+	    _ReplicaCursor, which loads the rows like the database
+	    cursors do."""
+
+	    def __init__(self, table, refresh=None, changed=None,
+			 deleted=None):
+		self.table = table
+		self.refresh = refresh
+		self.changed = changed
+		self.deleted = deleted
+		self.stale = 1
+		self.full = 1
+		self.loaded = None
+		self.watermark = None
+		self.lock = threading.Lock()
+		self.rows = {}
+		self.hashes = {}
+		self.stats = {'loads': 0, 'updates': 0, 'changed': 0}
+
+		columns = list(table.columns)
+		self.ncolumns = len(columns)
+		self.key = map(columns.index, table.primary_key or [])
+		for column in (changed, deleted):
+		    if column and column not in columns:
+			columns.append(column)
+		self.columns = columns
+		if changed: self.watermark_at = columns.index(changed)
+		if deleted: self.deleted_at = columns.index(deleted)
+
+	    def invalidate(self, deleted=0):
+		"""Note that the table was written to. Deleted rows can
+		only be found by loading the whole table again."""
+		if deleted: self.full = 1
+		self.stale = 1
+
+	    def _select(self, WHERE='', params=()):
+		table = self.table
+		session = table._session()
+		if session is not None: session.flush()
+		c = table.db.cursor()
+		c.execute("SELECT %s FROM %s%s" %
+			  (table._columns(self.columns), table.table,
+			   WHERE), params)
+		rows = c.fetchall()
+		c.close()
+		return rows
+
+	    def load(self):
+		"""Load all the rows of the table, and hash them on
+		the columns of each of its indices."""
+		self.lock.acquire()
+		try:
+		    # Cleared first, so that writes made while loading
+		    # leave the copy stale; set again if loading fails
+		    self.stale = self.full = 0
+		    try:
+			fetched = self._select()
+			watermark = self._watermark(fetched, None)
+			rows = {}
+			kept = []
+			for row in fetched:
+			    if self._is_tombstone(row): continue
+			    kept.append(row[:self.ncolumns])
+			    if self.key: rows[self._key(row)] = kept[-1]
+			    else: rows[len(rows)] = kept[-1]
+			hashes = {}
+			for index in self.table._indices():
+			    if index.extra_WHERE: continue
+			    columns = tuple(index.indices)
+			    if not hashes.has_key(columns):
+				hashes[columns] = self._hash(kept, columns)
+		    except:
+			self.stale = self.full = 1
+			raise
+		    # Swapped in together, for the readers in other threads
+		    self.rows, self.hashes = rows, hashes
+		    self.watermark = watermark
+		    self.loaded = time()
+		    self.stats['loads'] = self.stats['loads'] + 1
+		finally:
+		    self.lock.release()
+
+	    def update(self):
+		"""Bring the copy up to date, fetching only the rows
+		changed since the last load if possible."""
+		if self.full or not self.changed or self.loaded is None:
+		    return self.load()
+		self.lock.acquire()
+		try:
+		    self.stale = 0
+		    # >= rather than >, so that rows written later with
+		    # the same watermark are not missed; applying a row
+		    # twice does no harm
+		    WHERE = "\n    WHERE %s >= %s" % \
+			    (self.changed, self.table._values([None]))
+		    try:
+			if self.watermark is None: fetched = self._select()
+			else: fetched = self._select(WHERE, (self.watermark,))
+			for row in fetched: self._apply(row)
+		    except:
+			# Some rows may have been applied, start over
+			self.stale = self.full = 1
+			raise
+		    self.watermark = self._watermark(fetched,
+						     self.watermark)
+		    self.loaded = time()
+		    self.stats['updates'] = self.stats['updates'] + 1
+		    self.stats['changed'] = self.stats['changed'] + \
+					    len(fetched)
+		finally:
+		    self.lock.release()
+
+	    def _apply(self, row):
+		"""Put a changed row in place of the old one, in the
+		rows and in every hash. Hash buckets are replaced, not
+		modified, since other threads may be reading them."""
+		key = self._key(row)
+		old = self.rows.get(key)
+		if self._is_tombstone(row):
+		    new = None
+		    if old is not None: del self.rows[key]
+		else:
+		    new = self.rows[key] = row[:self.ncolumns]
+		for columns, hash in self.hashes.items():
+		    where = self._where(columns)
+		    if old is not None:
+			k = self._values(old, where)
+			bucket = filter(lambda r, key=key, s=self:
+					s._key(r) != key, hash.get(k, []))
+			if bucket: hash[k] = bucket
+			elif hash.has_key(k): del hash[k]
+		    if new is not None:
+			k = self._values(new, where)
+			hash[k] = hash.get(k, []) + [new]
+
+	    def _key(self, row):
+		return self._values(row, self.key)
+
+	    def _values(self, row, where):
+		return tuple(map(lambda i, r=row: r[i], where))
+
+	    def _where(self, columns):
+		return map(list(self.table.columns).index, columns)
+
+	    def _is_tombstone(self, row):
+		return self.deleted and row[self.deleted_at]
+
+	    def _watermark(self, rows, watermark):
+		if not self.changed: return None
+		for row in rows:
+		    value = row[self.watermark_at]
+		    if value is not None and (watermark is None or
+					      value > watermark):
+			watermark = value
+		return watermark
+
+	    def _hash(self, rows, columns):
+		where = self._where(columns)
+		hash = {}
+		for row in rows:
+		    hash.setdefault(self._values(row, where), []).append(row)
+		return hash
+
+	    def select(self, columns, i):
+		"""Returns a _ReplicaCursor over the rows whose columns
+		match the values in i."""
+		if self.stale or self.loaded is None or \
+		       (self.refresh is not None and
+			time() - self.loaded >= self.refresh):
+		    self.update()
+		hashes = self.hashes
+		columns = tuple(columns)
+		hash = hashes.get(columns)
+		if hash is None:
+		    # An index defined after the last load
+		    hash = hashes[columns] = self._hash(self.rows.values(),
+							columns)
+		table = self.table
+		load = table.load
+		session = table._session()
+		if session is not None:
+		    load = session.loader(table, table.columns, load)
+		return table._ReplicaCursor(hash.get(i, []), load)
+
+	class _ReplicaCursor:
+
+	    """The rows of a lookup in a _Replica, behaving like a
+	    _Cursor over them."""
+
+	    arraysize = 1
+
+	    def __init__(self, rows, load):
+		self.rows = rows
+		self.load = load
+		self.rowcount = len(rows)
+		self.pos = 0
+
+	    def fetchone(self):
+		"""Fetch the next object, or None."""
+		if self.pos >= len(self.rows): return None
+		self.pos = self.pos + 1
+		return self.load(self.rows[self.pos-1])
+
+	    def fetchall(self):
+		"""Fetch all the remaining objects."""
+		return self.fetchmany(len(self.rows))
+
+	    def fetchmany(self, size=None):
+		"""Fetch the next size objects (arraysize by default)."""
+		if size is None: size = self.arraysize
+		rows = self.rows[self.pos:self.pos+size]
+		self.pos = self.pos + len(rows)
+		return map(self.load, rows)
+
+	    def __iter__(self):
+		while self.pos < len(self.rows):
+		    yield self.fetchone()
+
+	    def close(self):
+		self.rows = []
+
+	def _primary_key_index(self):
+	    """Returns an Index on the primary key columns."""
+	    try:
+		return self._pk_index
+	    except AttributeError:
+		self._pk_index = self.Index(self.primary_key)
+		return self._pk_index
+
+	def _session(self):
+	    """Returns the open session of the SQLDict, or None."""
+	    if self.sqldict is None: return None
+	    return self.sqldict.session
+
 	def dump(self, v):
 	    """Default method. May be overridden. Must take single value
 	    argument, return a tuple compatible with the columns defined
@@ -271,6 +1059,8 @@ class SQLDict:
 	    def __init__(self, table, indices, WHERE):
 		i = map(lambda i: "%s = ?" % i, indices)
 		self.table = table
+		self.indices = indices
+		self.extra_WHERE = WHERE
 		self.WHERE =  "\n    WHERE "+ join(i, ' AND ') + WHERE
 
 	    def __setitem__(self, i=(), v=None):
@@ -279,15 +1069,180 @@ class SQLDict:
 		from types import *
 		if type(i) == ListType: i = tuple(i)
 		elif type(i) != TupleType: i = (i,)
-		self.table.update(v, i, WHERE=self.WHERE)
+		self.table.update(v, i, WHERE=self.WHERE,
+				  coalesce=self._coalesce())
+
+	    def _coalesce(self):
+		"""Whether updates through this index can be coalesced,
+		that is, the index fully identifies the rows and the
+		update does not change the indexed columns."""
+		if self.extra_WHERE: return 0
+		for column in self.indices:
+		    if column in self.table.updatecolumns: return 0
+		return 1
 
 	    def __getitem__(self, i=()):
-		"""Select items in the database matching i."""
+		"""Select items in the database matching i. On a
+		replicated table, they are looked up in memory."""
 		from types import *
 		if type(i) == ListType: i = tuple(i)
 		elif type(i) != TupleType: i = (i,)
+		replica = self.table.replica
+		if replica is not None and not self.extra_WHERE:
+		    return replica.select(self.indices, i)
 		return self.table.select(i, WHERE=self.WHERE)
 
+	    def select(self, i=(), columns=None):
+		"""Select items in the database matching i, loading only
+		the given columns up front."""
+		from types import ListType, TupleType
+		if type(i) == ListType: i = tuple(i)
+		elif type(i) != TupleType: i = (i,)
+		return self.table.select(i, WHERE=self.WHERE,
+					 columns=columns)
+
+	    def _order_key(self):
+		"""Returns the columns ordered scans sort by: the
+		index columns, then the primary key columns, so that
+		every row has its own place in the order."""
+		key = list(self.indices)
+		for k in self.table.primary_key or []:
+		    if k not in key: key.append(k)
+		return key
+
+	    def _compare(self, columns, op, values):
+		"""Returns a condition comparing columns with values
+		lexicographically, the way tuples compare, and its
+		parameters. values may be shorter than columns, and
+		then only that many columns are compared. The condition
+		is spelled out with = and op (one of <, <=, > or >=)
+		instead of using row values, which not every database
+		supports."""
+		from types import ListType, TupleType
+		if type(values) not in (ListType, TupleType):
+		    values = (values,)
+		if len(values) > len(columns):
+		    raise ValueError, "too many values for the index"
+		columns = columns[:len(values)]
+		strict = op[0]
+		terms = []
+		params = []
+		for n in range(len(columns)):
+		    if n == len(columns)-1: o = op
+		    else: o = strict
+		    term = map(lambda c, t=self.table: "%s = %s" %
+			       (c, t._values([c])), columns[:n])
+		    term.append("%s %s %s" % (columns[n], o,
+					      self.table._values([None])))
+		    terms.append(join(term, ' AND '))
+		    params.extend(values[:n+1])
+		if len(terms) == 1: return terms[0], params
+		return "(%s)" % join(map(lambda t: "(%s)" % t, terms),
+				     ' OR '), params
+
+	    def range(self, low=None, high=None, exclude_low=0,
+		      exclude_high=0, reverse=0, limit=None,
+		      columns=None, after=None):
+		"""Select the items whose index values lie between low
+		and high, in index order (or the reverse order, if
+		reverse is true). Either bound can be left out, and
+		for multi column indices a bound can give only the
+		first few columns. Both bounds are included unless
+		exclude_low or exclude_high are set.
+
+		after resumes a scan: it is the key (see page()) of
+		the last item already seen, and only the items that
+		come after it in the scan order are selected. limit
+		caps the number of items selected. columns is as for
+		select()."""
+		key = self._order_key()
+		if not key:
+		    raise ValueError, "range needs an index with columns"
+		if reverse: seek = '<'
+		else: seek = '>'
+
+		conditions = []
+		params = []
+		for bound, op, exclude, bounded in (
+			(low, '>', exclude_low, self.indices),
+			(high, '<', exclude_high, self.indices),
+			(after, seek, 1, key)):
+		    if bound is None: continue
+		    if not exclude: op = op + '='
+		    c, p = self._compare(bounded, op, bound)
+		    conditions.append(c)
+		    params.extend(p)
+		if not conditions and self.extra_WHERE:
+		    conditions.append("1 = 1")
+		WHERE = ''
+		if conditions:
+		    WHERE = "\n    WHERE " + join(conditions, ' AND ') + \
+			    self.extra_WHERE
+		if reverse: direction = ' DESC'
+		else: direction = ''
+		WHERE = WHERE + "\n    ORDER BY " + \
+			join(map(lambda c, d=direction: c+d, key), ', ')
+		if limit is not None: WHERE = WHERE + self.table._limit(limit)
+		return self.table.select(tuple(params), WHERE=WHERE,
+					 columns=columns)
+
+	    def between(self, low, high, columns=None):
+		"""Select the items whose index values lie between low
+		and high, both included, in index order."""
+		return self.range(low, high, columns=columns)
+
+	    def page(self, after=None, size=100, low=None, high=None,
+		     reverse=0, columns=None):
+		"""Returns a page of at most size items, in index order,
+		and the key to pass as after to get the next page, or
+		None after the last page. Unlike OFFSET, resuming from
+		the last key seen lets the database seek straight to
+		the page (given a database index on the index columns),
+		so deep pages cost the same as the first one."""
+		rows = []
+		c = self._keyed_range(rows, low, high, reverse, size,
+				      columns, after)
+		objects = c.fetchall()
+		if len(objects) < size: return objects, None
+		return objects, rows[-1]
+
+	    def scan(self, low=None, high=None, reverse=0, pagesize=1000,
+		     columns=None, after=None):
+		"""Iterate over the items between low and high in index
+		order, a page at a time (see page()), so that neither
+		the client nor the server has to hold the whole result
+		set."""
+		while 1:
+		    rows = []
+		    c = self._keyed_range(rows, low, high, reverse,
+					  pagesize, columns, after)
+		    n = 0
+		    for obj in c:
+			n = n + 1
+			yield obj
+		    if n < pagesize: break
+		    after = rows[-1]
+
+	    def _keyed_range(self, keys, low, high, reverse, limit,
+			     columns, after):
+		"""Like range(), but appends the key of each loaded
+		item to keys."""
+		key = self._order_key()
+		selected = list(self.table._select_columns(columns)[0])
+		try:
+		    where = map(selected.index, key)
+		except ValueError:
+		    raise ValueError, "ordered scans must load the " \
+			  "columns %s" % join(key, ', ')
+		c = self.range(low, high, reverse=reverse, limit=limit,
+			       columns=columns, after=after)
+		load = c.load
+		def keyed_load(row, load=load, keys=keys, where=where):
+		    keys.append(tuple(map(lambda i, r=row: r[i], where)))
+		    return load(row)
+		c.load = keyed_load
+		return c
+
 	    def __delitem__(self, i):
 		"""Delete items in the database matching i."""
 		from types import *
@@ -312,12 +1267,29 @@ class SQLDict:
 
 	    """A subclass (shadow class?) of a cursor object which knows how to
 	    load the tuples returned from the database into a more interesting
-	    object."""
+	    object.
+
+	    Iterating over a _Cursor fetches batchsize rows at a time and
+	    loads each object only when it is reached, so a whole table
+	    can be walked without having all of it in memory. With a
+	    server side cursor, the rows are not even kept in the client
+	    until they are fetched."""
 
-	    def __init__(self, db, load):
-		self.cursor = db.cursor()
+	    # Number of rows fetched at a time when iterating
+	    batchsize = 1000
+
+	    def __init__(self, db, load, server_side=0):
+		if server_side: self.cursor = self._server_cursor(db)
+		else: self.cursor = db.cursor()
 		self.load = load
 
+	    def _server_cursor(self, db):
+		"""Returns a cursor that keeps the result set on the
+		server. Named cursors are the closest thing the DB API
+		has to it (psycopg2 and others); subclasses for other
+		databases override this."""
+		return db.cursor('sqldict_%x' % id(self))
+
 	    def fetchone(self):
 		"""Fetch one object from current cursor context."""
 		x = self.cursor.fetchone()
@@ -333,28 +1305,126 @@ class SQLDict:
 		Can specify an optional size argument for number of rows."""
 		return map(self.load, apply(self.cursor.fetchmany, size))
 
+	    def __iter__(self):
+		"""Iterate over the objects of the current cursor context."""
+		load = self.load
+		fetchmany = self.cursor.fetchmany
+		while 1:
+		    rows = fetchmany(self.batchsize)
+		    if not rows: break
+		    for row in rows:
+			yield load(row)
+
 	    def __getattr__(self, attr):
 		return getattr(self.cursor, attr)
 
 
-	def cursor(self):
+	def cursor(self, server_side=0):
 	    """Returns a new _Cursor object which is load-aware and
 	    otherwise behaves normally."""
-	    return self._Cursor(self.db, self.load)
+	    return self._Cursor(self.db, self.load, server_side)
 
 
-    def Table(self, table, columns, updatecolumns=[]):
+    def Table(self, table, columns, updatecolumns=[], server_side=0,
+	      primary_key=None, deferred=None):
 
 	"""Add a new Table member.
 
 	Usage: db.Table(tablename, columns)
 	Where: tablename  = name of table in database
                columns    = tuple containing names of columns of interest
+	       server_side = whether selects use server side cursors
+	       primary_key = columns that identify a row
 
 	       """
 
-	return self._Table(self.db, table, columns, updatecolumns)
-
+	return self._Table(self.db, table, columns, updatecolumns,
+			   server_side, self, primary_key, deferred)
+
+
+def _bulk_value(v):
+    """Formats a value for the tab separated text read by COPY and
+    LOAD DATA."""
+    if v is None: return '\\N'
+    if type(v) is BooleanType: return v and '1' or '0'
+    if type(v) is UnicodeType: v = v.encode('utf-8')
+    elif type(v) is FloatType: v = repr(v)
+    else: v = str(v)
+    return v.replace('\\', '\\\\').replace('\t', '\\t') \
+	    .replace('\n', '\\n').replace('\r', '\\r')
+
+def _bulk_text(rows):
+    """Formats rows as the tab separated text read by COPY and LOAD
+    DATA, which both default to the same escapes."""
+    return join(map(lambda row: join(map(_bulk_value, row), '\t') + '\n',
+		    rows), '')
+
+# Functions called with the name of a table after each write to it
+# through a SQLDict table, such as the invalidation of query caches,
+# and again when SQLDict.commit() commits the write
+write_listeners = []
+
+def _written(table, sqldict=None):
+    if sqldict is not None: sqldict.uncommitted[table] = 1
+    for listener in write_listeners: listener(table)
+
+# Per class caches used by ObjectBuilder, so that looking up _set_ methods
+# and building loaders is done once per class instead of once per object
+_column_setter_cache = {}
+_setter_cache = {}
+_loader_cache = {}
+# ObjectBuilder class -> subclass that loads deferred columns
+_deferred_class_cache = {}
+
+def _deferred_getattr(self, key):
+    # Only called for attributes that are not set, which is how
+    # deferred columns get loaded on first access. Special methods
+    # such as __eq__ and __nonzero__ are looked up here too, as these
+    # are classic classes; fail fast on those.
+    if key[:2] == '__': raise AttributeError, key
+    deferred = self.__dict__.get('_deferred')
+    if deferred is not None and key in self.columns:
+	deferred.fetch(self, key)
+	try:
+	    return self.__dict__[key]
+	except KeyError:
+	    pass
+    raise AttributeError, key
+
+def _deferred_class(cls):
+    """Returns a subclass of cls with the __getattr__ hook that loads
+    deferred columns."""
+    if cls.__dict__.has_key('_loads_deferred'): return cls
+    try:
+	return _deferred_class_cache[cls]
+    except KeyError:
+	pass
+    attrs = {'__getattr__': _deferred_getattr,
+	     '__module__': cls.__module__,
+	     '_loads_deferred': 1}
+    if type(cls) is ClassType:
+	subclass = ClassType(cls.__name__, (cls,), attrs)
+    else:
+	subclass = type(cls)(cls.__name__, (cls,), attrs)
+    _deferred_class_cache[cls] = subclass
+    return subclass
+
+def _deferred_object(obj):
+    """Returns obj as an instance of its _deferred_class. Only objects
+    with columns left to load get the hook, as it slows down every
+    lookup of a missing attribute, special methods included. obj must
+    be a new object: classic instances can't change class while
+    ObjectBuilder.__setattr__ is in the way, so they are copied."""
+    cls = _deferred_class(obj.__class__)
+    if type(cls) is ClassType: return instance(cls, obj.__dict__)
+    object.__setattr__(obj, '__class__', cls)
+    return obj
+
+def _new_object(cls):
+    """Creates an instance of cls without calling its constructor."""
+    if type(cls) is ClassType:
+	return instance(cls, {})
+    return cls.__new__(cls)
 
 class ObjectBuilder:
 
@@ -372,6 +1442,18 @@ class ObjectBuilder:
         the value is a dbi type. Useful when working with date data.
     indices: A list of tuples. The first part of the tuple is the name
         of the index. The second part is a list of column names.
+    primary_key: List of columns that identify a row. Optional, used
+        by session identity maps and deferred columns.
+    deferred: List of columns that are not loaded with the others, but
+        on first access. Useful for large text or blob columns. Needs
+        primary_key.
+    replica: If true, the whole table is kept in memory and index
+        lookups are served from there (see SQLDict._Table.replicate).
+    replica_refresh: Seconds after which the in memory copy is loaded
+        again. By default, it is only loaded again after writes.
+    replica_changed: Column to poll for changed rows, so that only those
+        are loaded again. See SQLDict._Table.replicate.
+    replica_deleted: Column marking deleted rows (tombstones).
     """
 
     table = None
@@ -379,6 +1461,12 @@ class ObjectBuilder:
     updatecolumns = []
     special_types = {}
     indices = []
+    primary_key = None
+    deferred = []
+    replica = 0
+    replica_refresh = None
+    replica_changed = None
+    replica_deleted = None
 
     def __init__(self, *args, **kw):
 	"""
@@ -387,10 +1475,126 @@ class ObjectBuilder:
 	where the keys are from columns.
 	"""
 
-	for k in self.columns: setattr(self, k, None)
-	for i in range(len(args)):
-	    setattr(self, self.columns[i], args[i])
-	self.set_keywords(dict=kw)
+	if len(args) > len(self.columns): raise IndexError, 'too many values'
+	values = {}.fromkeys(self.columns)
+	values.update(zip(self.columns, args))
+	for k in kw.keys():
+	    if k not in self.columns: raise AttributeError, k
+	values.update(kw)
+	self._assign(values)
+
+    def _assign(self, values):
+	"""
+	Assigns a dictionary of column values. Columns that have a _set_
+	method are assigned through it, all others go straight into the
+	instance dictionary.
+	"""
+	setters = self._column_setters()
+	if setters:
+	    values = values.copy()
+	    setter_values = []
+	    for k, setter in setters:
+		if values.has_key(k):
+		    setter_values.append((setter, values.pop(k)))
+	    self.__dict__.update(values)
+	    for setter, v in setter_values:
+		setter(self, v)
+	else:
+	    self.__dict__.update(values)
+
+    def _column_setters(cls):
+	"""
+	Returns a list of (column, setter) for the columns that have a _set_
+	method. This is looked up once per class.
+	"""
+	try:
+	    return _column_setter_cache[cls]
+	except KeyError:
+	    setters = []
+	    for k in cls.columns:
+		setter = getattr(cls, '_set_'+k, None)
+		if setter is not None: setters.append((k, setter))
+	    _column_setter_cache[cls] = setters
+	    return setters
+    _column_setters = classmethod(_column_setters)
+
+    def _setter(cls, key):
+	"""
+	Returns the _set_ method for attribute key, or None if there's no
+	such method. This is looked up once per class and attribute.
+	"""
+	setters = _setter_cache.setdefault(cls, {})
+	try:
+	    return setters[key]
+	except KeyError:
+	    setter = setters[key] = getattr(cls, '_set_'+key, None)
+	    return setter
+    _setter = classmethod(_setter)
+
+    def loader(cls, columns=None):
+	"""
+	Returns a function that builds an instance out of a row with
+	the values of columns, as returned by the database. Unless the
+	class has its own __init__, the constructor is skipped and the
+	instance dictionary is built directly from the row.
+
+	If columns is given, rows only have values for those columns,
+	and the other columns are left unset, so that they can be
+	loaded later (see deferred).
+	"""
+	if columns is not None and list(columns) != list(cls.columns):
+	    return cls._partial_loader(tuple(columns))
+	try:
+	    return _loader_cache[cls]
+	except KeyError:
+	    pass
+
+	columns = tuple(cls.columns)
+	if getattr(cls.__init__, 'im_func', None) is not \
+	   ObjectBuilder.__init__.im_func:
+	    def load(row, cls=cls):
+		return apply(cls, row)
+	elif cls._column_setters() or type(cls) is not ClassType:
+	    def load(row, cls=cls, columns=columns):
+		obj = _new_object(cls)
+		values = {}.fromkeys(columns)
+		values.update(zip(columns, row))
+		obj._assign(values)
+		return obj
+	else:
+	    def load(row, cls=cls, columns=columns, n=len(columns)):
+		if len(row) == n:
+		    return instance(cls, dict(zip(columns, row)))
+		values = {}.fromkeys(columns)
+		values.update(zip(columns, row))
+		return instance(cls, values)
+
+	_loader_cache[cls] = load
+	return load
+    loader = classmethod(loader)
+
+    def _partial_loader(cls, columns):
+	try:
+	    return _loader_cache[cls, columns]
+	except KeyError:
+	    pass
+
+	if getattr(cls.__init__, 'im_func', None) is not \
+	   ObjectBuilder.__init__.im_func:
+	    missing = filter(lambda k, c=columns: k not in c, cls.columns)
+	    def load(row, cls=cls, columns=columns, missing=missing):
+		obj = apply(cls, (), dict(zip(columns, row)))
+		for k in missing: obj.__dict__.pop(k, None)
+		return obj
+	else:
+	    def load(row, cls=cls, columns=columns):
+		obj = _new_object(cls)
+		obj._assign(dict(zip(columns, row)))
+		return obj
+
+	_loader_cache[cls, columns] = load
+	return load
+    _partial_loader = classmethod(_partial_loader)
 
     def set_keywords(self, skim=0, dict={}):
 	"""
@@ -403,10 +1607,11 @@ class ObjectBuilder:
 	    elif not skim: raise AttributeError, k
 
     def __setattr__(self, key, value):
-	try:
-	    getattr(self, '_set_'+key)(value)
-	except AttributeError:
+	setter = self._setter(key)
+	if setter is None:
 	    self.__dict__[key] = value
+	else:
+	    setter(self, value)
 
     def __str__(self):
 	from string import join
@@ -436,12 +1641,15 @@ class ObjectBuilder:
 
     def register(self, db):
 	"""Register into database."""
-	t = db.Table(self.table, self.columns, self.updatecolumns)
-	loader = lambda t, s=self.__class__: apply(s, t)
+	t = db.Table(self.table, self.columns, self.updatecolumns,
+		     primary_key=self.primary_key, deferred=self.deferred)
 	setattr(t, 'dump', self.__class__.dump)
-	setattr(t, 'load', loader)
+	setattr(t, 'load', self.loader())
+	setattr(t, 'loader', self.__class__.loader)
 	for indexname, columns in self.indices:
 	    setattr(t, indexname, t.Index(columns))
+	if self.replica: t.replicate(self.replica_refresh, self.replica_changed,
+				    self.replica_deleted)
 	return t
 
 
@@ -459,6 +1667,31 @@ class MySQLDict(SQLDict):
 	    def __init__(self, table, indices, WHERE):
 		i = map(lambda i: "%s = %%s" % i, indices)
 		self.table = table
+		self.indices = indices
+		self.extra_WHERE = WHERE
 		self.WHERE =  "\n    WHERE "+ join(i, ' AND ') + WHERE
 
+	def _bulk_native(self, rows):
+	    """Send rows with LOAD DATA LOCAL INFILE, through a
+	    temporary file. The connection must allow it (the
+	    local_infile option of MySQLdb.connect)."""
+	    import tempfile
+	    f = tempfile.NamedTemporaryFile(prefix='sqldict', suffix='.tsv')
+	    try:
+		f.write(_bulk_text(rows))
+		f.flush()
+		self.db.cursor().execute(
+		    "LOAD DATA LOCAL INFILE %%s INTO TABLE %s\n"
+		    "    CHARACTER SET utf8 (%s)" %
+		    (self.table, self._columns(self.columns)), (f.name,))
+	    finally:
+		f.close()
+	    return 'load data'
+
+	class _Cursor(SQLDict._Table._Cursor):
+
+	    def _server_cursor(self, db):
+		from MySQLdb.cursors import SSCursor
+		return db.cursor(SSCursor)
+
 
@@ -44,7 +44,8 @@ def runquery(cursor, sql):
   
 def getdict(results, description):
     """Returns a list of ResultRow objects based upon already retrieved results 
-    and the query description returned from cursor.description"""
+    and the query description returned from cursor.description.  The list is
+    a ResultSet, which can also index the rows by column value."""
  
     # get the field names
     fields = {}
@@ -52,13 +53,139 @@ def getdict(results, description):
         fields[description[i][0]] = i
 
     # generate the list of ResultRow objects
-    rows = []
+    rows = ResultSet()
     for result in results:
         rows.append(ResultRow(result, fields))
 
     # return to the user
     return rows
 
+
+class ResultSet(list):
+    """A list of ResultRow objects that can find, group and sort its rows by
+    column value.  The hash and sort indexes behind these are built the first
+    time they are needed and then reused, so repeated lookups don't scan the
+    whole list.  Changing the list through its methods drops the indexes;
+    changing the rows themselves is not noticed."""
+
+    def __init__(self, rows=()):
+        list.__init__(self, rows)
+        self.indexes = {}
+
+    def _key(self, fields):
+        """Returns a function giving the value of the fields for a row: the
+        value itself for a single field, or a tuple of them"""
+        if len(fields) == 1:
+            field = fields[0]
+            return lambda row: row[field]
+        return lambda row: tuple([row[field] for field in fields])
+
+    def hashindex(self, *fields):
+        """Returns a dictionary of the rows keyed by the value of the given
+        fields (names or numbers).  Each value is the list of rows with that
+        key, in their order in the result set."""
+        name = ('hash',) + fields
+        if not self.indexes.has_key(name):
+            key = self._key(fields)
+            index = {}
+            for row in self:
+                index.setdefault(key(row), []).append(row)
+            self.indexes[name] = index
+        return self.indexes[name]
+
+    def find(self, *values, **fieldvalues):
+        """Returns the rows whose fields have the given values, as in
+        find(name='Bob') or find(('name', 'city'), ('Bob', 'Cleveland'))"""
+        if values:
+            fields, key = values
+            if type(fields) not in (type(()), type([])):
+                fields, key = (fields,), (key,)
+            else:
+                fields, key = tuple(fields), tuple(key)
+        else:
+            fields = tuple(fieldvalues.keys())
+            key = tuple(fieldvalues.values())
+        # Single field indexes are keyed by the bare value
+        if len(fields) == 1:
+            key = key[0]
+        return self.hashindex(*fields).get(key, [])
+
+    def findone(self, *values, **fieldvalues):
+        """Like find, but returns the first matching row, or None"""
+        rows = self.find(*values, **fieldvalues)
+        if rows:
+            return rows[0]
+        return None
+
+    def groupby(self, *fields):
+        """Returns a list of (key, rows) pairs, one for each distinct value of
+        the given fields, in the order the keys first show up"""
+        name = ('group',) + fields
+        if not self.indexes.has_key(name):
+            key = self._key(fields)
+            index = self.hashindex(*fields)
+            groups = []
+            for row in self:
+                k = key(row)
+                if index[k][0] is row:
+                    groups.append((k, index[k]))
+            self.indexes[name] = groups
+        return self.indexes[name]
+
+    def sortedby(self, *fields):
+        """Returns a new list of the rows sorted by the given fields"""
+        return list(self._sortindex(fields)[1])
+
+    def _sortindex(self, fields):
+        name = ('sort',) + fields
+        if not self.indexes.has_key(name):
+            key = self._key(fields)
+            rows = sorted(self, key=key)
+            self.indexes[name] = ([key(row) for row in rows], rows)
+        return self.indexes[name]
+
+    def between(self, fields, low=None, high=None):
+        """Returns the rows whose fields lie between low and high (both
+        included; either may be None for no bound), sorted by them.  fields
+        is a field or a tuple of fields, and the bounds are given the same
+        way."""
+        from bisect import bisect_left, bisect_right
+        if type(fields) not in (type(()), type([])):
+            fields = (fields,)
+        keys, rows = self._sortindex(tuple(fields))
+        start, end = 0, len(keys)
+        if low is not None:
+            start = bisect_left(keys, low)
+        if high is not None:
+            end = bisect_right(keys, high)
+        return rows[start:end]
+
+    def invalidate(self):
+        """Drops the indexes, which are then built again when needed"""
+        self.indexes = {}
+
+    def __changes(method):
+        def changed(self, *args, **kwargs):
+            self.indexes = {}
+            return method(self, *args, **kwargs)
+        changed.__name__ = method.__name__
+        changed.__doc__ = method.__doc__
+        return changed
+
+    append = __changes(list.append)
+    extend = __changes(list.extend)
+    insert = __changes(list.insert)
+    remove = __changes(list.remove)
+    pop = __changes(list.pop)
+    sort = __changes(list.sort)
+    reverse = __changes(list.reverse)
+    __setitem__ = __changes(list.__setitem__)
+    __delitem__ = __changes(list.__delitem__)
+    __setslice__ = __changes(list.__setslice__)
+    __delslice__ = __changes(list.__delslice__)
+    __iadd__ = __changes(list.__iadd__)
+    del __changes
+
   
 class ResultRow:
     """A single row in a result set with a dictionary-style and list-style interface"""
@@ -82,10 +82,8 @@ class Functionality:
                              required_parameters,
                              optional_parameters)
 
-    def __call__(self, args, kwargs):
-        # FIXME:
-        #    * Verify __call__ signature
-        return self.function.__call__(args, kwargs)
+    def __call__(self, *args, **kwargs):
+        return self.function(*args, **kwargs)
     
 if __name__ == '__main__':
 
@@ -28,25 +28,71 @@ gloco/gui.py
     gui related functionality module
 """
 
-__all__ = ["gui_available", "AboutDialog"]
+import os
+
+__all__ = ["gui_available", "set_gui_enabled", "get_about_dialog_class",
+           "AboutDialog"]
+
+# Result of probing for the GUI toolkit. None means it was not probed yet.
+_gui_available = None
+
+# Set with set_gui_enabled(), takes precedence over the environment
+_gui_enabled = None
+
+def set_gui_enabled(enabled):
+    """
+    Forces the GUI on (True) or off (False), or goes back to probing for the
+    toolkit (None). This overrides the GLOCO_GUI environment variable.
+    """
+    global _gui_enabled
+    _gui_enabled = enabled
 
 def gui_available():
     """
     Wheter or not there's a Graphical User Interface and Toolkit available.
+
+    The toolkit is only imported the first time this is called, and the
+    result is cached. Setting the GLOCO_GUI environment variable to 0/no/off
+    skips the probe altogether, which keeps console tools from paying for
+    the toolkit import.
     """
-    try:
-        import gtk
-    except:
+    global _gui_available
+
+    if _gui_enabled is not None:
+        if not _gui_enabled:
+            return False
+    elif os.environ.get('GLOCO_GUI', '').lower() in ('0', 'no', 'off'):
         return False
-    return True
 
-if gui_available():
+    if _gui_available is None:
+        try:
+            import gtk
+            _gui_available = True
+        except:
+            _gui_available = False
+    return _gui_available
+
+def get_about_dialog_class():
+    """
+    Returns the toolkit class used for about dialogs. Subclass what this
+    returns, not AboutDialog, to customize the dialog.
+    """
     import gtk
 
     major, minor, release = gtk.gtk_version
     assert major == 2
 
     if minor >= 6:
-        AboutDialog = gtk.AboutDialog
+        return gtk.AboutDialog
     else:
-        AboutDialog = gtk.Dialog
+        return gtk.Dialog
+
+def AboutDialog(*args, **kwargs):
+    """
+    Creates an about dialog, importing the toolkit only when needed.
+
+    This is a function, not a class, as the class depends on the toolkit
+    version and can't be known without importing it; see
+    get_about_dialog_class().
+    """
+    return get_about_dialog_class()(*args, **kwargs)
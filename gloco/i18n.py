@@ -29,16 +29,59 @@ gloco/i18n.py
 """
 
 import os
+import mmap
+import locale
+import struct
 import gettext
 
 from ConfigParser import ConfigParser
 
-__all__ = ["GetTranslationFunction"]
+__all__ = ["GetTranslationFunction", "MmapTranslations"]
+
+# Parsed configuration, along with the paths and modification times of the
+# files it was read from, so that the files are only parsed again if they
+# change
+_config_cache = {'paths' : None,
+                 'mtimes' : None,
+                 'parser' : None}
+
+# Translation functions, keyed by (domain, directory, languages, use_mmap)
+_translation_cache = {}
+
+def _GetModificationTimes(paths):
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+def GetConfigParser():
+    """
+    Returns a ConfigParser with the contents of the configuration files.
+    The files are parsed once, and again only when one of them changes.
+    """
+    paths = config_file_paths
+    if isinstance(paths, basestring):
+        paths = [paths]
+    paths = tuple(paths)
+    mtimes = _GetModificationTimes(paths)
+
+    if _config_cache['parser'] is None or \
+       _config_cache['paths'] != paths or \
+       _config_cache['mtimes'] != mtimes:
+        c = ConfigParser()
+        c.read(paths)
+        _config_cache.update({'paths' : paths,
+                              'mtimes' : mtimes,
+                              'parser' : c})
+
+    return _config_cache['parser']
 
 def GetConfigEntry(section, option):
-    c = ConfigParser()
+    c = GetConfigParser()
 
-    c.read(config_file_paths)
     if c.has_section(section):
         if c.has_option(section, option):
             return c.get(section, option)
@@ -51,10 +94,212 @@ def GetPathsBase():
         result = '/usr'
     return result
 
-def GetTranslationFunction():
+class MmapTranslations(gettext.NullTranslations):
+    """
+    A gettext translations class that reads a compiled (.mo) catalog through
+    a read-only memory map, instead of loading it into a dictionary.
+
+    Messages are found by a binary search on the (sorted) table of original
+    strings, so loading a catalog costs the same whatever its size, and all
+    processes using the same catalog share the page cache copy of it.
+    """
+    LE_MAGIC = 0x950412deL
+    BE_MAGIC = 0xde120495L
+
+    def _parse(self, fp):
+        filename = getattr(fp, 'name', '')
+        try:
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            raise IOError(0, 'Bad magic number', filename)
+
+        magic = struct.unpack('<I', self._data[:4])[0]
+        if magic == self.LE_MAGIC:
+            self._order = '<'
+        elif magic == self.BE_MAGIC:
+            self._order = '>'
+        else:
+            raise IOError(0, 'Bad magic number', filename)
+
+        version, self._count, self._originals, self._translated = \
+                 struct.unpack(self._order + '4I', self._data[4:20])
+
+        self.plural = lambda n: int(n != 1)
+        self.__parse_metadata()
+
+    def __parse_metadata(self):
+        """
+        Reads the charset and plural forms from the catalog header, which is
+        the translation of the empty string
+        """
+        index = self.__find('')
+        if index is None:
+            return
+        lastk = None
+        for item in self.__get_string(self._translated, index).split('\n'):
+            item = item.strip()
+            if not item:
+                continue
+            k = v = None
+            if ':' in item:
+                k, v = item.split(':', 1)
+                k = k.strip().lower()
+                v = v.strip()
+                self._info[k] = v
+                lastk = k
+            elif lastk:
+                self._info[lastk] += '\n' + item
+            if k == 'content-type':
+                self._charset = v.split('charset=')[1]
+            elif k == 'plural-forms':
+                plural = v.split(';')[1].split('plural=')[1]
+                self.plural = gettext.c2py(plural)
+
+    def __get_string(self, table, index):
+        """
+        Returns the string at index of the table of originals or translations
+        """
+        start = table + index * 8
+        length, offset = struct.unpack(self._order + '2I',
+                                       self._data[start:start + 8])
+        return self._data[offset:offset + length]
+
+    def __find(self, message, plural=False):
+        """
+        Returns the index of message in the catalog, or None if it is not
+        there. Plural entries are stored as 'singular\0plural', and are
+        found by their singular form when plural is True.
+        """
+        if plural:
+            message += '\0'
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self.__get_string(self._originals, middle) < message:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            original = self.__get_string(self._originals, low)
+            if original == message or (plural and original.startswith(message)):
+                return low
+        return None
+
+    def __encode(self, message):
+        if isinstance(message, unicode):
+            return message.encode(self._charset or 'ascii')
+        return message
+
+    def __translate(self, message, form=None):
+        """
+        Returns the translation of message, or the given plural form of it,
+        or None if there's no translation
+        """
+        index = self.__find(self.__encode(message), form is not None)
+        if index is None:
+            return None
+        tmsg = self.__get_string(self._translated, index)
+        if form is None:
+            return tmsg
+        forms = tmsg.split('\0')
+        if form >= len(forms):
+            return None
+        return forms[form]
+
+    def __recode(self, tmsg, charset):
+        """
+        Returns a translation, as stored in the catalog, in the given charset
+        """
+        if not charset:
+            return tmsg
+        return unicode(tmsg, self._charset or 'ascii').encode(charset)
+
+    def gettext(self, message):
+        tmsg = self.__translate(message)
+        if tmsg is None:
+            if self._fallback:
+                return self._fallback.gettext(message)
+            return message
+        return self.__recode(tmsg, self._output_charset)
+
+    def lgettext(self, message):
+        tmsg = self.__translate(message)
+        if tmsg is None:
+            if self._fallback:
+                return self._fallback.lgettext(message)
+            return message
+        return self.__recode(tmsg, self._output_charset or
+                             locale.getpreferredencoding())
+
+    def ugettext(self, message):
+        tmsg = self.__translate(message)
+        if tmsg is None:
+            if self._fallback:
+                return self._fallback.ugettext(message)
+            return unicode(message)
+        return unicode(tmsg, self._charset or 'ascii')
+
+    def ngettext(self, msgid1, msgid2, n):
+        tmsg = self.__translate(msgid1, self.plural(n))
+        if tmsg is None:
+            if self._fallback:
+                return self._fallback.ngettext(msgid1, msgid2, n)
+            if n == 1:
+                return msgid1
+            return msgid2
+        return self.__recode(tmsg, self._output_charset)
+
+    def lngettext(self, msgid1, msgid2, n):
+        tmsg = self.__translate(msgid1, self.plural(n))
+        if tmsg is None:
+            if self._fallback:
+                return self._fallback.lngettext(msgid1, msgid2, n)
+            if n == 1:
+                return msgid1
+            return msgid2
+        return self.__recode(tmsg, self._output_charset or
+                             locale.getpreferredencoding())
+
+    def ungettext(self, msgid1, msgid2, n):
+        tmsg = self.__translate(msgid1, self.plural(n))
+        if tmsg is None:
+            if self._fallback:
+                return self._fallback.ungettext(msgid1, msgid2, n)
+            if n == 1:
+                return unicode(msgid1)
+            return unicode(msgid2)
+        return unicode(tmsg, self._charset or 'ascii')
+
+def GetTranslationFunction(domain='', languages=None, use_mmap=False):
+    """
+    Returns the gettext function for the given domain and languages. The
+    catalog is only loaded the first time a given combination is asked for.
+
+    If use_mmap is True, the catalog is read through a MmapTranslations
+    instead of being parsed into memory.
+    """
     translation_directory = os.path.join(GetPathsBase(), 'share/locale')
-    try:
-        t = gettext.translation('', translation_directory)
-        return t.gettext
-    except:
-        return str
+    if languages is not None:
+        languages = tuple(languages)
+
+    if use_mmap:
+        translation_class = MmapTranslations
+    else:
+        translation_class = None
+
+    key = (domain, translation_directory, languages, use_mmap)
+    if not _translation_cache.has_key(key):
+        try:
+            t = gettext.translation(domain, translation_directory, languages,
+                                    translation_class)
+            _translation_cache[key] = t.gettext
+        except:
+            _translation_cache[key] = str
+    return _translation_cache[key]
+
+def ClearCaches():
+    """
+    Forgets the cached configuration and translation functions
+    """
+    _config_cache['parser'] = None
+    _translation_cache.clear()
@@ -28,11 +28,245 @@ gloco/shell.py
    shell module
 """
 
+import os
 import cmd
 import sys
+import time
+import Queue
+import StringIO
+import threading
+import traceback
+
+try:
+    import cProfile as profile
+except ImportError:
+    import profile
+import pstats
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 import gloco.app
 
+class JobOutput:
+    '''
+    A file like object that wraps the shell output stream. Writes coming from
+    a thread running a background job go to that job's own buffer, while
+    everything else goes straight to the wrapped stream.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def set_buffer(self, buffer):
+        '''
+        Sets the buffer that will receive writes from the current thread
+        '''
+        self.local.buffer = buffer
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            buffer.write(data)
+        else:
+            self.stream.write(data)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+class Job:
+    '''
+    A command line that is run in the background by a JobPool
+    '''
+    PENDING = 'Pending'
+    RUNNING = 'Running'
+    DONE = 'Done'
+    FAILED = 'Failed'
+    CANCELLED = 'Cancelled'
+
+    def __init__(self, number, line):
+        self.number = number
+        self.line = line
+        self.status = Job.PENDING
+        self.output = StringIO.StringIO()
+        self.error = None
+        self.reported = False
+        self.finished = threading.Event()
+
+    def is_finished(self):
+        return self.finished.isSet()
+
+    def get_output(self):
+        '''
+        Returns everything the job has written so far
+        '''
+        return self.output.getvalue()
+
+
+class JobPool:
+    '''
+    A pool of worker threads that run shell command lines in the background.
+
+    Workers are only started when the first job is submitted, so shells that
+    never use background jobs do not pay for any threads.
+    '''
+    def __init__(self, shell, size):
+        self.shell = shell
+        self.size = size
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.jobs = {}
+        self.next_number = 1
+
+    def __start_workers(self):
+        while len(self.workers) < self.size:
+            worker = threading.Thread(target=self.__work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def __work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            self.lock.acquire()
+            try:
+                cancelled = job.status == Job.CANCELLED
+                if not cancelled:
+                    job.status = Job.RUNNING
+            finally:
+                self.lock.release()
+            if cancelled:
+                continue
+
+            self.shell.stdout.set_buffer(job.output)
+            try:
+                try:
+                    self.shell.run_job_line(job.line)
+                    job.status = Job.DONE
+                except:
+                    job.error = traceback.format_exc()
+                    job.status = Job.FAILED
+            finally:
+                self.shell.stdout.set_buffer(None)
+                job.finished.set()
+
+    def submit(self, line):
+        '''
+        Queues a command line for execution, returning its Job
+        '''
+        self.lock.acquire()
+        try:
+            job = Job(self.next_number, line)
+            self.jobs[job.number] = job
+            self.next_number += 1
+        finally:
+            self.lock.release()
+
+        self.__start_workers()
+        self.queue.put(job)
+        return job
+
+    def get_jobs(self):
+        '''
+        Returns all known jobs, sorted by their number
+        '''
+        numbers = self.jobs.keys()
+        numbers.sort()
+        return [self.jobs[number] for number in numbers]
+
+    def get_unfinished_jobs(self):
+        return [job for job in self.get_jobs() if not job.is_finished()]
+
+    def cancel(self, job):
+        '''
+        Cancels a job that has not started running yet. Returns True if the
+        job was cancelled and False otherwise, since a running thread cannot
+        be safely interrupted.
+        '''
+        self.lock.acquire()
+        try:
+            if job.status != Job.PENDING:
+                return False
+            job.status = Job.CANCELLED
+        finally:
+            self.lock.release()
+        job.finished.set()
+        return True
+
+    def shutdown(self):
+        '''
+        Waits for all queued jobs to finish and stops the worker threads
+        '''
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+class PrefixTree:
+    '''
+    A prefix tree (trie) of words, used to find all words starting with a
+    given prefix without scanning the whole word list. Lookups are cached,
+    since completion asks for the same prefixes over and over.
+    '''
+    def __init__(self, words=()):
+        self.root = {}
+        self.cache = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        '''
+        Adds a word to the tree
+        '''
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        # None can never be a character, so it marks the end of a word
+        node[None] = word
+        self.cache.clear()
+
+    def find(self, prefix):
+        '''
+        Returns a sorted list of the words that start with prefix
+        '''
+        if self.cache.has_key(prefix):
+            return self.cache[prefix]
+
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                break
+
+        words = []
+        if node is not None:
+            nodes = [node]
+            while nodes:
+                node = nodes.pop()
+                for char, child in node.items():
+                    if char is None:
+                        words.append(child)
+                    else:
+                        nodes.append(child)
+            words.sort()
+
+        self.cache[prefix] = words
+        return words
+
+
 class Shell(cmd.Cmd):
     '''
     A command line interpreter, based on the 'cmd' module of the  standard
@@ -40,6 +274,12 @@ class Shell(cmd.Cmd):
     '''
     positive_answers = ('', 'y', 'Y')
 
+    # Number of worker threads used to run background jobs ('command &')
+    max_jobs = 4
+
+    # Number of functions shown by the 'profile' command
+    profile_limit = 20
+
     def __init__(self):
         cmd.Cmd.__init__(self)
 
@@ -50,6 +290,15 @@ class Shell(cmd.Cmd):
 
         self.readline_initialized = False
 
+        self.job_pool = None
+
+        self.functionalities = {}
+        self.command_index = None
+        self.argument_index = {}
+
+        self.timing_enabled = False
+        self.timings = {}
+
 
 
     def __init_readline(self):
@@ -78,6 +327,142 @@ class Shell(cmd.Cmd):
                 readline.set_completer(self.old_completer)
 
 
+    def __init_jobs(self):
+        '''
+        Initializes the background job pool, capturing the output stream so
+        that each job gets its own output
+        '''
+        if self.job_pool is None:
+            if not isinstance(self.stdout, JobOutput):
+                self.stdout = JobOutput(self.stdout)
+            self.job_pool = JobPool(self, self.max_jobs)
+
+
+    def __cleanup_jobs(self):
+        '''
+        Waits for the background jobs to finish and restores the output stream
+        '''
+        if self.job_pool is not None:
+            unfinished = self.job_pool.get_unfinished_jobs()
+            if unfinished:
+                self.stdout.write('Waiting for %s background job(s)\n' %
+                                  len(unfinished))
+            self.job_pool.shutdown()
+            self.__report_jobs()
+            self.stdout = self.stdout.stream
+            self.job_pool = None
+
+
+    def __report_jobs(self):
+        '''
+        Prints a notice about background jobs that finished since the last
+        time this was called
+        '''
+        if self.job_pool is not None:
+            for job in self.job_pool.get_jobs():
+                if job.is_finished() and not job.reported:
+                    job.reported = True
+                    self.stdout.write('[%s] %s\t%s\n' % (job.number,
+                                                           job.status,
+                                                           job.line))
+
+
+    def __get_job(self, arg):
+        '''
+        Returns the job whose number is given as the argument, printing a
+        message and returning None if there's no such job
+        '''
+        job = None
+        if self.job_pool is not None:
+            try:
+                job = self.job_pool.jobs.get(int(arg))
+            except ValueError:
+                pass
+        if job is None:
+            self.stdout.write('*** No such job: %s\n' % arg)
+        return job
+
+
+    def __build_completion_index(self):
+        '''
+        Builds the prefix trees used for command and argument completion
+        '''
+        commands = [name[3:] for name in self.get_names()
+                    if name.startswith('do_')]
+        commands.extend(self.functionalities.keys())
+        self.command_index = PrefixTree(commands)
+
+        self.argument_index = {}
+        for name, functionality in self.functionalities.items():
+            self.argument_index[name] = PrefixTree(
+                ['%s=' % arg for arg in functionality.function_args])
+
+
+    def invalidate_completion(self):
+        '''
+        Throws away the completion index, so that it gets rebuilt on the next
+        completion. Call this after adding do_* methods at runtime.
+        '''
+        self.command_index = None
+        self.argument_index = {}
+
+
+    def add_functionality(self, functionality):
+        '''
+        Makes a gloco.functionality.Functionality available as a command,
+        named after its shortname.
+        '''
+        self.functionalities[functionality.shortname] = functionality
+        self.invalidate_completion()
+
+
+    def __measure(self, dispatch, line):
+        '''
+        Runs a command line with dispatch, onecmd or run_job_line, returning
+        what it returned plus the wall clock and CPU time spent
+        '''
+        start_wall = time.time()
+        start_cpu = sum(os.times()[:2])
+        stop = dispatch(line)
+        cpu = sum(os.times()[:2]) - start_cpu
+        wall = time.time() - start_wall
+        return stop, wall, cpu
+
+
+    def __record_timing(self, line, wall, cpu):
+        '''
+        Adds the time a command took to the session timings
+        '''
+        if not line.strip():
+            # An empty line repeated the last command
+            line = self.lastcmd
+            if not line:
+                return
+        command = self.parseline(line)[0] or line
+        count, total_wall, total_cpu = self.timings.get(command, (0, 0.0, 0.0))
+        self.timings[command] = (count + 1, total_wall + wall, total_cpu + cpu)
+
+
+    def __print_timing_summary(self):
+        '''
+        Prints the timings recorded while 'timing' was on
+        '''
+        if not self.timings:
+            return
+        summary = [(total_wall, command, count, total_cpu)
+                   for command, (count, total_wall, total_cpu)
+                   in self.timings.items()]
+        summary.sort()
+        summary.reverse()
+
+        self.stdout.write('%-20s %8s %10s %10s\n' % ('command', 'calls',
+                                                     'real', 'cpu'))
+        for total_wall, command, count, total_cpu in summary:
+            self.stdout.write('%-20s %8d %9.3fs %9.3fs\n' % (command, count,
+                                                            total_wall,
+                                                            total_cpu))
+
+
     def __print_intro(self, intro):
         '''
         Prints the intro text
@@ -102,6 +487,7 @@ class Shell(cmd.Cmd):
         stop = None        
         try:
             while not stop:
+                self.__report_jobs()
                 if self.cmdqueue:
                     line = self.cmdqueue.pop(0)
                 else:
@@ -119,12 +505,196 @@ class Shell(cmd.Cmd):
                         else:
                             line = line[:-1] # chop \n
                 line = self.precmd(line)
-                stop = self.onecmd(line)
+                if self.timing_enabled:
+                    stop, wall, cpu = self.__measure(self.onecmd, line)
+                    self.__record_timing(line, wall, cpu)
+                else:
+                    stop = self.onecmd(line)
                 stop = self.postcmd(stop, line)
             self.postloop()             # Hook
+            self.__print_timing_summary()
         finally:
+            self.__cleanup_jobs()
             self.__cleanup_readline()
 
+    def onecmd(self, line):
+        '''
+        Just like cmd.Cmd.onecmd, but a line ending with '&' is run in the
+        background, and the prompt returns immediately.
+        '''
+        line = line.strip()
+        if line.endswith('&') and len(line) > 1:
+            return self.background(line[:-1].rstrip())
+        return cmd.Cmd.onecmd(self, line)
+
+    def run_job_line(self, line):
+        '''
+        Dispatches a command line like cmd.Cmd.onecmd does, but leaves
+        self.lastcmd alone, so that a background job is never what an empty
+        line at the prompt repeats
+        '''
+        command, arg, line = self.parseline(line)
+        if not line:
+            return None
+        if not command:
+            return self.default(line)
+        try:
+            function = getattr(self, 'do_' + command)
+        except AttributeError:
+            return self.default(line)
+        return function(arg)
+
+    def background(self, line):
+        '''
+        Runs a command line on the background job pool. Output written to
+        self.stdout by the command is collected and shown by 'wait'.
+        '''
+        self.__init_jobs()
+        job = self.job_pool.submit(line)
+        self.stdout.write('[%s] %s\n' % (job.number, job.line))
+
+    def default(self, line):
+        '''
+        Runs a functionality added with add_functionality(). Arguments in
+        the form name=value are passed as keyword arguments, all others as
+        positional ones.
+        '''
+        command, arg, line = self.parseline(line)
+        functionality = self.functionalities.get(command)
+        if functionality is None:
+            return cmd.Cmd.default(self, line)
+
+        args = []
+        kwargs = {}
+        for token in arg.split():
+            name, sep, value = token.partition('=')
+            if sep and name in functionality.function_args:
+                kwargs[name] = value
+            else:
+                args.append(token)
+
+        try:
+            result = functionality(*args, **kwargs)
+        except (TypeError, ValueError), e:
+            # A bad argument must not end the command loop
+            self.stdout.write('*** %s\n' % e)
+            self.stdout.write('*** Usage: %s\n' % functionality.syntax)
+            return
+        if result is not None:
+            self.stdout.write('%s\n' % (result,))
+
+    def completenames(self, text, *ignored):
+        '''
+        Completes command names, using the completion index instead of
+        scanning the class attributes on every call
+        '''
+        if self.command_index is None:
+            self.__build_completion_index()
+        return self.command_index.find(text)
+
+    def completedefault(self, text, line, begidx, endidx):
+        '''
+        Completes 'name=' arguments of functionalities
+        '''
+        command = self.parseline(line)[0]
+        if command not in self.functionalities:
+            return []
+        if self.command_index is None:
+            self.__build_completion_index()
+        return self.argument_index[command].find(text)
+
+    def do_time(self, line):
+        '''
+        Runs a command and prints how long it took, in wall clock and CPU
+        time, and the peak memory size of the process, when available
+        '''
+        # run_job_line leaves lastcmd alone, as this may run as a job
+        stop, wall, cpu = self.__measure(self.run_job_line, line)
+        self.stdout.write('real %.3fs  cpu %.3fs' % (wall, cpu))
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            self.stdout.write('  peak memory %sk' % usage.ru_maxrss)
+        self.stdout.write('\n')
+        return stop
+
+    def do_profile(self, line):
+        '''
+        Runs a command under the python profiler and prints the call count
+        and time of the functions where most time was spent
+        '''
+        profiler = profile.Profile()
+        stop = profiler.runcall(self.run_job_line, line)
+        stats = pstats.Stats(profiler, stream=self.stdout)
+        stats.sort_stats('cumulative').print_stats(self.profile_limit)
+        return stop
+
+    def do_timing(self, line):
+        '''
+        Turns recording the time of every command on or off. Without an
+        argument, shows the times recorded so far
+        '''
+        line = line.strip().lower()
+        if line == 'on':
+            self.timing_enabled = True
+        elif line == 'off':
+            self.timing_enabled = False
+        elif line:
+            self.stdout.write('*** Usage: timing [on|off]\n')
+        else:
+            self.__print_timing_summary()
+
+    def do_jobs(self, line):
+        '''
+        Lists the background jobs and their status
+        '''
+        self.__report_jobs()
+        if self.job_pool is not None:
+            for job in self.job_pool.get_unfinished_jobs():
+                self.stdout.write('[%s] %s\t%s\n' % (job.number,
+                                                       job.status,
+                                                       job.line))
+
+    def do_wait(self, line):
+        '''
+        Waits for a background job (or all of them, if no job number is
+        given) to finish, and prints its output
+        '''
+        if line.strip():
+            job = self.__get_job(line.strip())
+            if job is None:
+                return
+            jobs = [job]
+        elif self.job_pool is not None:
+            jobs = self.job_pool.get_jobs()
+        else:
+            jobs = []
+
+        for job in jobs:
+            job.finished.wait()
+            job.reported = True
+            self.stdout.write('[%s] %s\t%s\n' % (job.number,
+                                                   job.status,
+                                                   job.line))
+            self.stdout.write(job.get_output())
+            if job.error:
+                self.stdout.write(job.error)
+
+    def do_cancel(self, line):
+        '''
+        Cancels a background job that has not started running yet
+        '''
+        job = self.__get_job(line.strip())
+        if job is None:
+            return
+        if self.job_pool.cancel(job):
+            self.stdout.write('[%s] %s\t%s\n' % (job.number,
+                                                   job.status,
+                                                   job.line))
+            job.reported = True
+        else:
+            self.stdout.write('*** Job %s is %s and cannot be cancelled\n' %
+                              (job.number, job.status.lower()))
+
     def do_EOF(self, line):
         '''
         This implements the default action on EOF, quitting the application
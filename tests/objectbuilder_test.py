@@ -0,0 +1,72 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2005 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+
+"""
+Compares how many rows per second are turned into objects by the
+ObjectBuilder loader and by the original, setattr based, implementation.
+"""
+
+import time
+
+from gloco.ext.db.SQLDict import ObjectBuilder
+
+columns = ['Name', 'Address', 'City', 'State', 'Zip', 'Phone']
+
+class Person(ObjectBuilder):
+    columns = columns
+
+class LegacyPerson:
+    """
+    The ObjectBuilder constructor and __setattr__, as they used to be
+    """
+    columns = columns
+
+    def __init__(self, *args, **kw):
+        for k in self.columns: setattr(self, k, None)
+        for i in range(len(args)):
+            setattr(self, self.columns[i], args[i])
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+    def __setattr__(self, key, value):
+        try:
+            getattr(self, '_set_'+key)(value)
+        except AttributeError:
+            self.__dict__[key] = value
+
+def rows_per_second(load, rows):
+    start = time.time()
+    objects = map(load, rows)
+    return len(rows) / (time.time() - start)
+
+if __name__ == '__main__':
+    rows = [('Name %s' % i, '%s Slack Ln' % i, 'Cleveland', 'OH', '44101',
+             '555-%04d' % i) for i in range(100000)]
+
+    legacy = rows_per_second(lambda t, s=LegacyPerson: apply(s, t), rows)
+    loader = rows_per_second(Person.loader(), rows)
+
+    print 'Legacy loader: %10.0f rows/s' % legacy
+    print 'Loader:        %10.0f rows/s (%.1fx)' % (loader, loader / legacy)
@@ -0,0 +1,66 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2005 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+
+"""
+Measures the time it takes to import gloco.app and create an application on
+a console, and checks that the GUI toolkit is never imported on the way.
+"""
+
+import os
+import sys
+import subprocess
+
+startup_code = """
+import sys, time
+start = time.time()
+import gloco.app
+app = gloco.app.App('startup_test', 'startup test application')
+print time.time() - start
+print 'gtk' in sys.modules
+"""
+
+def measure_console_startup(runs=10):
+    """
+    Returns the best of a number of console startup times, in seconds
+    """
+    # GLOCO_GUI=no would skip the toolkit probe, hiding an import of gtk
+    environ = os.environ.copy()
+    environ.pop('GLOCO_GUI', None)
+
+    times = []
+    for run in range(runs):
+        process = subprocess.Popen([sys.executable, '-c', startup_code],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=environ)
+        output, errors = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('startup failed:\n%s' % errors)
+        elapsed, gtk_imported = output.split()
+        assert gtk_imported == 'False', 'console startup imported gtk'
+        times.append(float(elapsed))
+    return min(times)
+
+if __name__ == '__main__':
+    print 'Console startup: %.1f ms' % (measure_console_startup() * 1000)